@@ -6,12 +6,15 @@
 # ## Build residuals
 # The validated data are nuisance regressed against the training data in the transducitve prediction step. In order to get their residual maps, I will repeat the nuisance regression separately for each model and seed region and store them here.
 
+import sys
 import tqdm
 import numpy as np
 import pandas as pd
 import patsy as pat
 import pathlib as pal
-from sklearn import linear_model as sln
+
+sys.path.insert(0, str(pal.Path(__file__).resolve().parents[1] / "figures"))
+from asdfc import stats
 
 root_p = pal.Path(
     "/home/nclarke/projects/rrg-pbellec/nclarke/TSM_NO_BACKUP/ASD_project_clean"
@@ -33,29 +36,17 @@ seed_stack_discovery = np.load(seed_stack_discovery_p)
 # ## Residuals
 # We are regressing age, head motion, and intercept.
 
+# Each validation subject is appended on its own to the discovery sample. The discovery fit is factorized once and
+# every validation subject only adds a rank-one update, for all networks at once.
+design_discovery = pat.dmatrix("AGE_AT_SCAN + fd_scrubbed", pheno_discovery)
+design_valid = pat.dmatrix("AGE_AT_SCAN + fd_scrubbed", pheno_valid)
+residualizer = stats.IncrementalResidualizer(seed_stack_discovery, design_discovery)
 resid_stack_valid = np.zeros(shape=seed_stack_valid.shape)
-total_jobs = np.prod((resid_stack_valid.shape[0], resid_stack_valid.shape[2]))
-with tqdm.tqdm(total=total_jobs) as pbar:
-    for itix, (rid, row) in enumerate(pheno_valid.iterrows()):
-        it_pheno = pd.concat(
-            [
-                pheno_discovery[["AGE_AT_SCAN", "fd_scrubbed"]],
-                row[["AGE_AT_SCAN", "fd_scrubbed"]]
-                .to_frame()
-                .T,  # Convert row to DataFrame
-            ]
+with tqdm.tqdm(total=seed_stack_valid.shape[0]) as pbar:
+    for itix in range(seed_stack_valid.shape[0]):
+        resid_stack_valid[itix] = residualizer.test_residuals(
+            seed_stack_valid[itix], design_valid[itix]
         )
-        it_mat = pat.dmatrix("AGE_AT_SCAN + fd_scrubbed", it_pheno)
-        for nid in range(18):
-            it_stack = np.concatenate(
-                (
-                    seed_stack_discovery[..., nid],
-                    seed_stack_valid[itix, :, nid][None, :],
-                )
-            )
-            mod = sln.LinearRegression(fit_intercept=False, n_jobs=-1)
-            res = mod.fit(it_mat, it_stack)
-            resid_stack_valid[itix, :, nid] = (it_stack - res.predict(it_mat))[-1, :]
-        pbar.update(18)
+        pbar.update(1)
 
 np.save(resid_stack_valid_p, resid_stack_valid)
@@ -1 +1 @@
-from asdfc import stats, wrappers, data, tools
+from asdfc import stats, wrappers, data, tools, conformal, logistic, scheduler, aggregate, validation, null_model
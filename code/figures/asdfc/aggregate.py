@@ -0,0 +1,191 @@
+import os
+import numpy as np
+import pandas as pd
+import pathlib as pal
+from .conformal import N_REPLICATES, N_NETWORKS, format_r_numeric, load_discovery_results
+
+# Networks combined by each model of each grouping. p1_networks and p0_networks only differ for the single network
+# models of the hierarchy splits, where the R scripts take the p value and the p0 value from different networks.
+SUBNETS_P = pal.Path(__file__).with_name('subnets.tsv')
+
+
+def read_subnets(subnets_p=SUBNETS_P):
+    """
+    :param subnets_p: pathlib path to a tab separated table with the columns grouping, model, p1_networks and
+                      p0_networks. Networks are space separated and 1-based
+    :return: pandas DataFrame with one row per model. The network columns hold lists of ints
+    """
+    subnets = pd.read_csv(subnets_p, sep='\t', dtype={'p1_networks': str, 'p0_networks': str})
+    for col in ['p1_networks', 'p0_networks']:
+        subnets[col] = [[int(net) for net in nets.split()] for nets in subnets[col]]
+    return subnets
+
+
+def combine_p_values(p_values, network_lists, n_networks=N_NETWORKS):
+    """
+    Combine p values across networks like the R scripts: sqrt(2 * mean(p^2)) over the networks of a model. Models
+    with a single network give sqrt(2 * p). All models are combined at once by two matrix products.
+
+    :param p_values: array (..., n_networks)
+    :param network_lists: list of lists of 1-based networks, one list per model
+    :param n_networks: number of networks
+    :return: array (..., n_models). Models with a missing (NaN) network are NaN
+    """
+    p_values = np.asarray(p_values, dtype=float)
+    squared = np.zeros((n_networks, len(network_lists)))
+    single = np.zeros((n_networks, len(network_lists)))
+    for model_id, networks in enumerate(network_lists):
+        if len(networks) == 1:
+            single[networks[0] - 1, model_id] = 1
+        else:
+            squared[np.array(networks) - 1, model_id] = 1
+    n_squared = np.maximum(squared.sum(0), 1)
+    missing = np.isnan(p_values)
+    filled = np.where(missing, 0, p_values)
+    combined = np.sqrt(2 * ((filled ** 2 @ squared) / n_squared + filled @ single))
+    combined[(missing @ (squared + single)) > 0] = np.nan
+    return combined
+
+
+def combine_groupings(p_values, p0_values, subnets, groupings):
+    """
+    :param p_values: array (..., n_networks) of the p values (label 1)
+    :param p0_values: array (..., n_networks) of the p0 values (label 0)
+    :param subnets: pandas DataFrame, see read_subnets
+    :param groupings: list of groupings to combine
+    :return: dict that maps each grouping to a tuple of the combined p and p0 values, each (..., n_models)
+    """
+    rows = subnets[subnets['grouping'].isin(groupings)]
+    p_comb = combine_p_values(p_values, list(rows['p1_networks']))
+    p0_comb = combine_p_values(p0_values, list(rows['p0_networks']))
+    grouping_of_row = rows['grouping'].values
+    return {grouping: (p_comb[..., grouping_of_row == grouping], p0_comb[..., grouping_of_row == grouping])
+            for grouping in groupings}
+
+
+def write_r_table(out_p, matrix):
+    """
+    Write a matrix with the same bytes as write.table(matrix, file, sep="\\t") in R for a numeric matrix without
+    dimnames. Written to a temporary name first and then moved in place
+
+    :param out_p: pathlib path to the output file
+    :param matrix: 2D array. NaN is written as NA
+    :return: pathlib path to the output file
+    """
+    out_p = pal.Path(out_p)
+    matrix = np.asarray(matrix, dtype=float)
+    lines = ['\t'.join(f'"V{col_id}"' for col_id in range(1, matrix.shape[1] + 1))]
+    lines += ['\t'.join([f'"{row_id}"'] + [format_r_numeric(val) for val in row]) for row_id, row in
+              enumerate(matrix.tolist(), 1)]
+    tmp_p = out_p.with_name(f'.{out_p.name}.{os.getpid()}.tmp')
+    with open(tmp_p, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmp_p, out_p)
+    return out_p
+
+
+def prediction_performance(p_values, p0_values, labels, thr=0.2, empty_value=np.nan):
+    """
+    Precision, specificity and sensitivity of the prediction region (p > thr and p0 <= thr) as computed in the
+    figure notebooks, for all replicates and models at once. Undefined ratios are NaN.
+
+    :param p_values: array (n_replicates, n_subjects, n_models) of combined p values
+    :param p0_values: array of the same shape of combined p0 values
+    :param labels: array (n_replicates, n_subjects) of 0/1 labels
+    :param thr: float. Significance threshold
+    :param empty_value: value of all three when the prediction region is empty. The notebook that writes
+                        table_split.csv catches the division by zero and uses 0
+    :return: tuple of arrays (n_replicates, n_models): precision, specificity and sensitivity
+    """
+    region = (p_values > thr) & (p0_values <= thr)
+    labels = np.asarray(labels, dtype=bool)[..., None]
+    tp = np.sum(region & labels, 1)
+    fp = np.sum(region & ~labels, 1)
+    tn = np.sum(~region & ~labels, 1)
+    p = np.sum(labels, 1)
+    n = np.sum(~labels, 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        performance = tp / (tp + fp), tn / n, tp / p
+    for values in performance:
+        values[(tp + fp) == 0] = empty_value
+    return performance
+
+
+def write_discovery_tables(discovery_dir, source_dir, debug=False, subnets_p=SUBNETS_P, thr=0.2):
+    """
+    Python equivalent of Discovery_Read_Conformal_Scores.R followed by the table_split.csv export of the
+    figure_1_network notebook. Writes combined_networks_{model}_p0/p1.tsv for the subnet grouping,
+    split_net_{model}_p0/p1.tsv for the split_1 grouping and table_split.csv.
+
+    Like the R script, only replicates with results for network 1 are used and they fill the first columns of the
+    tables, so this can be run on a partial discovery run to monitor its progress.
+
+    :param discovery_dir: path to the discovery output folder, see conformal.load_discovery_results
+    :param source_dir: path to the folder with ABIDE1_Pheno_PSM_matched.tsv
+    :param debug: if True, only use the first 20 subjects of the phenotype table
+    :param subnets_p: pathlib path to the table of subnets, see read_subnets
+    :param thr: float. Significance threshold of table_split.csv
+    :return: pandas DataFrame of table_split.csv
+    """
+    discovery_dir = pal.Path(discovery_dir)
+    results = load_discovery_results(discovery_dir)
+    available = np.flatnonzero(~np.isnan(results[:, 0, 0, 0]))
+    results = np.asarray(results[available])
+    n_columns = max(N_REPLICATES, len(available))
+
+    combined = combine_groupings(results[:, :, 2, :], results[:, :, 3, :], read_subnets(subnets_p),
+                                 ['subnet', 'split_1'])
+    for grouping, name in [('subnet', 'combined_networks'), ('split_1', 'split_net')]:
+        for label, values in zip(['p1', 'p0'], combined[grouping]):
+            # (replicate, subject, model) to one (subject, replicate) table per model
+            table = np.full((n_columns, values.shape[1], values.shape[2]), np.nan)
+            table[:len(available)] = values
+            for model_id in range(values.shape[2]):
+                write_r_table(discovery_dir / f'{name}_{model_id + 1}_{label}.tsv', table[..., model_id].T)
+
+    pheno = pd.read_csv(pal.Path(source_dir) / 'ABIDE1_Pheno_PSM_matched.tsv', sep='\t')
+    if debug:
+        pheno = pheno.iloc[:20]
+    has_autism = (pheno['DX_GROUP'] == 'Autism').values
+    labels = has_autism[results[:, :, 1, 0].astype(int) - 1]
+    precision, specificity, sensitivity = prediction_performance(*combined['split_1'], labels, thr=thr,
+                                                                 empty_value=0)
+    table_split = pd.DataFrame({'precision': precision.T.ravel(), 'specificity': specificity.T.ravel(),
+                                'sensitivity': sensitivity.T.ravel(),
+                                'network': np.repeat([f'group_{model_id + 1}' for model_id in
+                                                      range(precision.shape[1])], precision.shape[0])})
+    table_split.to_csv(discovery_dir / 'table_split.csv', index=False)
+    return table_split
+
+
+def load_validation_results(validation_dir):
+    """
+    :param validation_dir: path to the folder with the Results_Real_Network_{network}.csv files
+    :return: 3D array (n_subjects, n_fields, n_networks), fields as in asdfc.data.RESULT_FIELDS
+    """
+    return np.stack([pd.read_csv(pal.Path(validation_dir) / f'Results_Real_Network_{network}.csv').values[:, 1:]
+                     for network in range(1, N_NETWORKS + 1)], -1).astype(float)
+
+
+def write_validation_tables(validation_dir, subnets_p=SUBNETS_P):
+    """
+    Python equivalent of Validation_Read_Conformal_Scores.R. Writes
+    validation_net_split_{split}_model_{model}_combined_p_values.tsv for every split_{split} grouping of the subnet
+    table, with the combined p values in the first column and the combined p0 values in the second.
+
+    :param validation_dir: path to the validation output folder
+    :param subnets_p: pathlib path to the table of subnets, see read_subnets
+    :return: list of pathlib paths of the written tables
+    """
+    validation_dir = pal.Path(validation_dir)
+    results = load_validation_results(validation_dir)
+    subnets = read_subnets(subnets_p)
+    splits = [grouping for grouping in subnets['grouping'].unique() if grouping.startswith('split_')]
+    combined = combine_groupings(results[:, 2, :], results[:, 3, :], subnets, splits)
+    out_list = list()
+    for grouping in splits:
+        p_comb, p0_comb = combined[grouping]
+        for model_id in range(p_comb.shape[1]):
+            out_p = validation_dir / f'validation_net_{grouping}_model_{model_id + 1}_combined_p_values.tsv'
+            out_list.append(write_r_table(out_p, np.column_stack([p_comb[:, model_id], p0_comb[:, model_id]])))
+    return out_list
@@ -0,0 +1,434 @@
+import os
+import re
+import math
+import numpy as np
+import pandas as pd
+import pathlib as pal
+import multiprocessing as mp
+from scipy.spatial import distance as ssd
+from .stats import ward_d_cut, LeaveOneInClustering
+from .data import seed_store_path, ensure_seed_store, open_seed_store, RESULT_FIELDS, create_results_store, \
+    write_results_block, open_results_store
+from .logistic import R_DBL_EPSILON, R_LOGIT_THRESH, R_GLM_EPSILON, R_GLM_MAXIT, EPS_VAL, \
+    glm_logit_fit, conformal_p_value, conformal_p_values
+
+# Constant used by R's Mersenne-Twister so we can reproduce the R scripts exactly. The glm.fit constants are in
+# asdfc.logistic
+R_MT_SCALE = 2.3283064365386963e-10
+
+
+def r_mersenne_twister(random_seed):
+    """
+    Build a numpy MT19937 bit generator in the same state as R after set.seed(random_seed)
+
+    :param random_seed: int. The seed passed to set.seed in R
+    :return: numpy.random.MT19937 bit generator
+    """
+    seed = int(random_seed) & 0xffffffff
+    # Initial scrambling done by R's RNG_Init
+    for _ in range(50):
+        seed = (69069 * seed + 1) & 0xffffffff
+    key = np.empty(625, dtype=np.uint32)
+    for i in range(625):
+        seed = (69069 * seed + 1) & 0xffffffff
+        key[i] = seed
+    # The first element is the position (mti) which FixupSeeds resets to 624
+    bit_generator = np.random.MT19937()
+    bit_generator.state = {'bit_generator': 'MT19937', 'state': {'key': key[1:], 'pos': 624}}
+    return bit_generator
+
+
+def r_unif_rand(bit_generator):
+    # R's MT_genrand followed by fixup to stay inside (0, 1)
+    value = int(bit_generator.random_raw()) * R_MT_SCALE
+    if value <= 0:
+        return 0.5 * R_MT_SCALE
+    if 1 - value <= 0:
+        return 1 - 0.5 * R_MT_SCALE
+    return value
+
+
+def r_sample(bit_generator, n, size):
+    """
+    Reproduce sample(1:n, size, replace=TRUE) with R's default "Rejection" sampling (R >= 3.6)
+
+    :param bit_generator: generator from r_mersenne_twister. The state is advanced in place
+    :param n: int. Sample from 1 to n
+    :param size: int. Number of draws
+    :return: 1D integer array of 1-based indices
+    """
+    bits = int(math.ceil(math.log2(n))) if n > 1 else 0
+    draws = np.empty(size, dtype=int)
+    for i in range(size):
+        while True:
+            value = 0
+            for _ in range(0, bits + 1, 16):
+                value = 65536 * value + int(math.floor(r_unif_rand(bit_generator) * 65536))
+            value &= (1 << bits) - 1
+            if value < n:
+                break
+        draws[i] = value + 1
+    return draws
+
+
+def r_bootstrap_indices(random_seed, n_subjects):
+    """
+    Generate the bootstrap training and testing samples of discovery_conformal_score.R
+
+    :param random_seed: int. Seed passed to set.seed
+    :param n_subjects: int. Number of subjects in the phenotype table
+    :return: tuple of 1D integer arrays (bootstrap_train, bootstrap_test), 1-based like in R
+    """
+    bit_generator = r_mersenne_twister(random_seed)
+    bootstrap_train = r_sample(bit_generator, n_subjects, n_subjects)
+    bootstrap_test = r_sample(bit_generator, n_subjects, n_subjects)
+    return bootstrap_train, bootstrap_test
+
+
+def ward_d_partition(resid_map, n_subtypes):
+    """
+    Reproduce hclust(Dist(resid_map), method='ward.D') followed by cutree(k=n_subtypes)
+
+    :param resid_map: 2D array (n_subjects, n_voxels)
+    :param n_subtypes: int
+    :return: 1D array of subtype labels from 1 to n_subtypes, numbered by first appearance like cutree
+    """
+    return ward_d_cut(ssd.pdist(resid_map), n_subtypes)
+
+
+def conformal_scores(working_map, regressed_vars, classes_var, bootstrap_train, bootstrap_test, n_subtypes=5,
+                     dtype=None, warm_start=False):
+    """
+    Leave-one-in conformal scores of discovery_conformal_score.R for one network
+
+    :param working_map: 2D array (n_subjects, n_voxels) of seed maps for one network
+    :param regressed_vars: 2D array (n_subjects, n_factors) of nuisance design, including the intercept
+    :param classes_var: 1D array of 0/1 labels (1 = autism)
+    :param bootstrap_train: 1D array of 1-based indices of the training subjects
+    :param bootstrap_test: 1D array of 1-based indices of the test subjects
+    :param n_subtypes: int. Number of subtypes cut from the ward tree
+    :param dtype: floating point type of the residual maps. Defaults to asdfc.stats.COMPUTE_DTYPE
+    :param warm_start: start the label 0 logistic fits from the label 1 solutions, see
+                       asdfc.logistic.conformal_p_values. False reproduces glm.fit as called by the R script
+    :return: tuple of 1D arrays (p_values, p0_values)
+    """
+    train = np.asarray(bootstrap_train) - 1
+    test = np.asarray(bootstrap_test) - 1
+    # The training set is the same for every test subject, so its regression and distances are only computed once
+    clustering = LeaveOneInClustering(working_map, regressed_vars, train_index=train, dtype=dtype)
+    designs = leave_one_in_designs(clustering, working_map[test, :], regressed_vars[test, :], n_subtypes,
+                                   test_subjects=test)
+    return conformal_p_values(designs, classes_var[train], warm_start=warm_start)
+
+
+def leave_one_in_designs(clustering, test_map, test_vars, n_subtypes=5, test_subjects=None):
+    """
+    Logistic regression designs of the conformal scores: intercept and the correlations of every scaled residual
+    map with the mean maps of the ward.D subtypes, with each test subject appended on its own to the training set
+
+    :param clustering: asdfc.stats.LeaveOneInClustering of the training set
+    :param test_map: 2D array (n_test, n_voxels) of seed maps of the test subjects
+    :param test_vars: 2D array (n_test, n_factors) of nuisance design of the test subjects
+    :param n_subtypes: int. Number of subtypes cut from the ward tree
+    :param test_subjects: 1D array of 0-based rows of the test subjects in the data of the clustering, when they can
+                          also be training subjects. See asdfc.stats.LeaveOneInClustering.augmented_index
+    :return: 3D array (n_test, n_train + 1, n_subtypes + 1). The test subject is the last row of each design
+    """
+    designs = np.empty((test_map.shape[0], len(clustering.inverse) + 1, n_subtypes + 1))
+    designs[..., 0] = 1
+    for i_test in range(test_map.shape[0]):
+        subject = None if test_subjects is None else test_subjects[i_test]
+        _, designs[i_test, :, 1:] = clustering.subtypes(test_map[i_test], test_vars[i_test], n_subtypes, subject)
+    return designs
+
+
+def compare_conformal_dtype(working_map, regressed_vars, classes_var, bootstrap_train, bootstrap_test,
+                            dtype=np.float32, n_sample=20, random_state=0):
+    """
+    Check how much a lower precision compute dtype changes the conformal p-values compared to float64
+
+    :param working_map: 2D array (n_subjects, n_voxels) of seed maps for one network
+    :param regressed_vars: 2D array (n_subjects, n_factors) of nuisance design, including the intercept
+    :param classes_var: 1D array of 0/1 labels (1 = autism)
+    :param bootstrap_train: 1D array of 1-based indices of the training subjects
+    :param bootstrap_test: 1D array of 1-based indices of the test subjects
+    :param dtype: the compute dtype to check
+    :param n_sample: number of test subjects drawn at random for the check. None uses all of them
+    :param random_state: seed used to draw the sample
+    :return: dict with the largest absolute deviation of p_values and p0_values
+    """
+    bootstrap_test = np.asarray(bootstrap_test)
+    if n_sample is not None and n_sample < len(bootstrap_test):
+        rng = np.random.default_rng(random_state)
+        bootstrap_test = bootstrap_test[np.sort(rng.choice(len(bootstrap_test), n_sample, replace=False))]
+    ref_p, ref_p0 = conformal_scores(working_map, regressed_vars, classes_var, bootstrap_train, bootstrap_test,
+                                     dtype=np.float64)
+    p, p0 = conformal_scores(working_map, regressed_vars, classes_var, bootstrap_train, bootstrap_test, dtype=dtype)
+    return {'p_values_max_abs': np.max(np.abs(ref_p - p)), 'p0_values_max_abs': np.max(np.abs(ref_p0 - p0))}
+
+
+def format_r_numeric(value):
+    """
+    Format a number like R's write.csv does: 15 significant digits, fixed or scientific, whichever is shorter
+
+    :param value: float
+    :return: str
+    """
+    if np.isnan(value):
+        return 'NA'
+    if np.isinf(value):
+        return 'Inf' if value > 0 else '-Inf'
+    if value == 0:
+        return '0'
+    mantissa, exponent = f'{value:.14e}'.split('e')
+    mantissa = mantissa.rstrip('0').rstrip('.')
+    exponent = int(exponent)
+    n_sig = len(mantissa.replace('-', '').replace('.', ''))
+    sci = f'{mantissa}e{"-" if exponent < 0 else "+"}{abs(exponent):02d}'
+    fixed = f'{value:.{max(0, n_sig - 1 - exponent)}f}'
+    return fixed if len(fixed) <= len(sci) else sci
+
+
+def write_results_csv(out_p, bootstrap_train, bootstrap_test, p_values, p0_values):
+    """
+    Write a Results_Instance_*.csv file with the same bytes as write.csv(cbind(...)) in R
+
+    The file is written to a temporary name first and then moved in place, so interrupted runs never leave
+    partial results behind.
+
+    :param out_p: pathlib path to the output .csv file
+    :return: True if the file exists
+    """
+    out_p = pal.Path(out_p)
+    columns = ['bootstrap_train', 'bootstrap_test', 'p_values', 'p0_values']
+    lines = [','.join(['""'] + [f'"{col}"' for col in columns])]
+    for row_id, row in enumerate(zip(bootstrap_train, bootstrap_test, p_values, p0_values), 1):
+        lines.append(','.join([f'"{row_id}"'] + [format_r_numeric(float(val)) for val in row]))
+    tmp_p = out_p.with_name(f'.{out_p.name}.{os.getpid()}.tmp')
+    with open(tmp_p, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmp_p, out_p)
+    return out_p.is_file()
+
+
+def load_discovery_data(source_dir, debug=False):
+    """
+    Load the discovery seed maps and phenotypes once
+
+    :param source_dir: path to the folder with seed_maps_no_cereb.npy and ABIDE1_Pheno_PSM_matched.tsv
+    :param debug: if True, only keep the first 20 subjects of the phenotype table
+    :return: tuple of (seed_store, regressed_vars, classes_var). The seed store is the read-only, memory mapped
+             network-major stack of shape (n_networks, n_subjects, n_voxels)
+    """
+    source_dir = pal.Path(source_dir)
+    store_p = seed_store_path(source_dir / 'seed_maps_no_cereb.npy')
+    if not store_p.is_file():
+        store_p = ensure_seed_store(source_dir / 'seed_maps_no_cereb.npy')
+    seed_store = open_seed_store(store_p)
+    pheno = pd.read_csv(source_dir / 'ABIDE1_Pheno_PSM_matched.tsv', sep='\t')
+    if debug:
+        pheno = pheno.iloc[:20]
+    regressed_vars = np.column_stack([np.ones(len(pheno)), pheno['AGE_AT_SCAN'].values,
+                                      pheno['fd_scrubbed'].values]).astype(float)
+    classes_var = np.where(pheno['DX_GROUP'].values == 'Control', 0, 1)
+    return seed_store, regressed_vars, classes_var
+
+
+N_REPLICATES = 100
+N_NETWORKS = 18
+RESULTS_STORE = 'Results_Store'
+_RESULT_RE = re.compile(r'Results_Instance_(\d+)_Network_(\d+)\.csv')
+
+
+def discovery_result_path(output_dir, replicate, network):
+    return pal.Path(output_dir) / f'Results_Instance_{replicate}_Network_{network}.csv'
+
+
+def discovery_store_dir(output_dir):
+    return pal.Path(output_dir) / RESULTS_STORE
+
+
+def discovery_n_subjects(source_dir, debug=False):
+    """
+    :param source_dir: path to the folder with ABIDE1_Pheno_PSM_matched.tsv
+    :param debug: if True, count only the first 20 subjects like load_discovery_data
+    :return: int. Number of subjects of a discovery run
+    """
+    n_subjects = len(pd.read_csv(pal.Path(source_dir) / 'ABIDE1_Pheno_PSM_matched.tsv', sep='\t'))
+    return min(n_subjects, 20) if debug else n_subjects
+
+
+def ensure_discovery_store(output_dir, n_subjects, n_replicates=N_REPLICATES):
+    """
+    Create the results store of a discovery run in output_dir unless it exists, see asdfc.data.create_results_store
+
+    :param output_dir: path to the discovery output folder
+    :param n_subjects: int. Number of subjects
+    :param n_replicates: int. Number of replicates the store has room for
+    :return: pathlib path to the store folder
+    """
+    return create_results_store(discovery_store_dir(output_dir), n_replicates, n_subjects, N_NETWORKS)
+
+
+def _discovery_csv_jobs(output_dir):
+    # (replicate, network) of the Results_Instance_*.csv files in output_dir, from a single listing of the folder
+    jobs = set()
+    if not os.path.isdir(output_dir):
+        return jobs
+    with os.scandir(output_dir) as entries:
+        for entry in entries:
+            match = _RESULT_RE.fullmatch(entry.name)
+            if match is not None and entry.is_file():
+                jobs.add((int(match.group(1)), int(match.group(2))))
+    return jobs
+
+
+def existing_discovery_results(output_dir):
+    """
+    Find the finished discovery jobs from the done flags of the results store and a single listing of the output
+    folder for the .csv files of the R engine, instead of one stat per job
+
+    :param output_dir: path to the discovery output folder
+    :return: set of (replicate, network) tuples, both 1-based
+    """
+    done = _discovery_csv_jobs(output_dir)
+    store_dir = discovery_store_dir(output_dir)
+    if store_dir.is_dir():
+        _, store_done = open_results_store(store_dir)
+        done.update((int(rep) + 1, int(net) + 1) for rep, net in zip(*np.nonzero(store_done)))
+    return done
+
+
+def consolidate_discovery_results(output_dir, remove=True, jobs=None):
+    """
+    Move the Results_Instance_*.csv files of the R engine into the results store of output_dir. The store is
+    created from the first file if there is none yet.
+
+    :param output_dir: path to the discovery output folder
+    :param remove: if True, delete each .csv file once its results are in the store
+    :param jobs: iterable of (replicate, network) tuples to consolidate. None consolidates every .csv file in the
+                 folder, which is only safe when no other process is still writing results into it
+    :return: list of (replicate, network) tuples that were moved
+    """
+    csv_jobs = _discovery_csv_jobs(output_dir)
+    if jobs is not None:
+        csv_jobs &= set(jobs)
+    csv_jobs = sorted(csv_jobs)
+    if not csv_jobs:
+        return []
+    store_dir = discovery_store_dir(output_dir)
+    moved = list()
+    for replicate, network in csv_jobs:
+        csv_p = discovery_result_path(output_dir, replicate, network)
+        try:
+            block = pd.read_csv(csv_p).values[:, 1:].T
+        except FileNotFoundError:
+            # Another process consolidating the same folder was faster
+            continue
+        if not store_dir.is_dir():
+            ensure_discovery_store(output_dir, block.shape[1], max(N_REPLICATES, csv_jobs[-1][0]))
+        write_results_block(store_dir, replicate - 1, network - 1, block)
+        if remove:
+            csv_p.unlink(missing_ok=True)
+        moved.append((replicate, network))
+    return moved
+
+
+def load_discovery_results(discovery_dir, networks=None):
+    """
+    All results of a discovery run as one array. Results in the store are returned as a memory map without reading
+    them. Results that are only available as .csv files, like older archives, are read and merged into a copy.
+
+    :param discovery_dir: path to the discovery output folder
+    :param networks: list of 1-based networks to load. None loads all N_NETWORKS as a view of the store
+    :return: 4D array (n_replicates, n_subjects, n_fields, n_networks) with the fields of asdfc.data.RESULT_FIELDS.
+             Missing results are NaN
+    """
+    networks = list(range(1, N_NETWORKS + 1)) if networks is None else list(networks)
+    store_dir = discovery_store_dir(discovery_dir)
+    csv_jobs = sorted(job for job in _discovery_csv_jobs(discovery_dir) if job[1] in networks)
+    if store_dir.is_dir():
+        results, _ = open_results_store(store_dir)
+        if not networks == list(range(1, N_NETWORKS + 1)):
+            results = results[..., np.array(networks) - 1]
+        if not csv_jobs:
+            return results
+        results = np.array(results)
+    elif csv_jobs:
+        n_subjects = len(pd.read_csv(discovery_result_path(discovery_dir, *csv_jobs[0])))
+        results = np.full((max(rep for rep, _ in csv_jobs), n_subjects, len(RESULT_FIELDS), len(networks)), np.nan)
+    else:
+        raise Exception(f'No discovery results in {discovery_dir}')
+    for replicate, network in csv_jobs:
+        results[replicate - 1, :, :, networks.index(network)] = pd.read_csv(
+            discovery_result_path(discovery_dir, replicate, network)).values[:, 1:]
+    return results
+
+
+def run_discovery_instance(seed_store, regressed_vars, classes_var, random_seed, replicate, network, output_dir):
+    """
+    Python equivalent of one Rscript discovery_conformal_score.R call. The results go into the results store of
+    output_dir instead of a .csv file, see ensure_discovery_store
+
+    :param seed_store: 3D network-major array (n_networks, n_subjects, n_voxels), see asdfc.data.open_seed_store
+    :param regressed_vars: 2D nuisance design (n_subjects, n_factors)
+    :param classes_var: 1D array of 0/1 labels
+    :param random_seed: int. Seed passed to set.seed in R
+    :param replicate: int. 1-based replicate number
+    :param network: int. 1-based network number
+    :param output_dir: path to the output folder
+    :return: pathlib path to the results store
+    """
+    bootstrap_train, bootstrap_test = r_bootstrap_indices(random_seed, len(classes_var))
+    working_map = np.asarray(seed_store[network - 1], dtype=float)
+    p_values, p0_values = conformal_scores(working_map, regressed_vars, classes_var, bootstrap_train, bootstrap_test)
+    store_dir = ensure_discovery_store(output_dir, len(classes_var), max(N_REPLICATES, replicate))
+    write_results_block(store_dir, replicate - 1, network - 1,
+                        np.stack([bootstrap_train, bootstrap_test, p_values, p0_values]))
+    return store_dir
+
+
+# State of a discovery worker process, loaded once in _init_discovery_worker
+_worker_data = dict()
+
+
+def _init_discovery_worker(source_dir, output_dir, debug):
+    from threadpoolctl import threadpool_limits
+    # Limit internal threading to 1 to avoid nested parallelism
+    threadpool_limits(1)
+    _worker_data['data'] = load_discovery_data(source_dir, debug)
+    _worker_data['output_dir'] = output_dir
+
+
+def _run_discovery_job(job):
+    replicate, network = job
+    out_p = run_discovery_instance(*_worker_data['data'], replicate, replicate, network, _worker_data['output_dir'])
+    return replicate, network, str(out_p)
+
+
+def run_discovery_jobs(jobs, source_dir, output_dir, debug=False, n_procs=1):
+    """
+    Run many discovery jobs in long-lived worker processes. The seed maps are converted once to a network-major store
+    that all workers memory map read-only, so they share a single copy in the page cache
+
+    :param jobs: iterable of (replicate, network) tuples, both 1-based. The replicate is also the random seed
+    :param source_dir: path to the source data folder
+    :param output_dir: path to the output folder
+    :param debug: if True, only use the first 20 subjects
+    :param n_procs: number of worker processes
+    :return: list of (replicate, network, results store path) for the jobs that were run
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    done = existing_discovery_results(output_dir)
+    jobs = [job for job in jobs if job not in done]
+    if not jobs:
+        return []
+    # Build the stores before the workers start so they don't race to write them
+    ensure_seed_store(pal.Path(source_dir) / 'seed_maps_no_cereb.npy')
+    ensure_discovery_store(output_dir, discovery_n_subjects(source_dir, debug),
+                           max(N_REPLICATES, max(rep for rep, _ in jobs)))
+    if n_procs == 1:
+        _init_discovery_worker(source_dir, output_dir, debug)
+        return [_run_discovery_job(job) for job in jobs]
+    with mp.Pool(n_procs, initializer=_init_discovery_worker, initargs=(source_dir, output_dir, debug)) as pool:
+        return list(pool.imap_unordered(_run_discovery_job, jobs))
@@ -1,16 +1,22 @@
+import os
+import socket
 import warnings
+import numpy as np
 import nibabel as nib
 import pathlib as pal
+import multiprocessing as mp
 from scipy import io as sio
+from .wrappers import unpacker
 
 
-def niak_scrubbing(img_p, extra_p, out_p, clobber=False):
+def niak_scrubbing(img_p, extra_p, out_p, clobber=False, chunk_frames=50):
     """
 
     :param img_p: pathlib path to the functional image file
     :param extra_p: pathlib path to the .mat file that contains the scrubbing mask
     :param out_p: pathlib path to the output functional image file
     :param clobber: if true, overwrite existing output image file
+    :param chunk_frames: maximum number of frames read from the image at a time
     :return:
     """
     if not issubclass(type(out_p), pal.Path):
@@ -20,7 +26,8 @@ def niak_scrubbing(img_p, extra_p, out_p, clobber=False):
         warnings.warn(f'{out_p.name} already exists and clobber = {clobber}. Not touching anything:\n {out_p}')
         return out_p.is_file()
 
-    img = nib.load(str(img_p))
+    # Keep one file handle open so that compressed images are decompressed front to back only once
+    img = nib.load(str(img_p), keep_file_open=True)
     extra = sio.loadmat(str(extra_p))
 
     scrub_mask = extra['mask_scrubbing'].squeeze()
@@ -28,6 +35,251 @@ def niak_scrubbing(img_p, extra_p, out_p, clobber=False):
     if not len(scrub_mask) == img.shape[-1]:
         raise Exception(f'Shape mismatch between {img_p.name} and {extra_p.name}: {img.shape} vs {len(scrub_mask)}')
 
-    masked_img = nib.Nifti1Image(img.get_data()[..., scrub_mask != 1], affine=img.affine, header=img.header)
+    # Only read the retained frames, as runs of consecutive frames of at most chunk_frames
+    keep = np.flatnonzero(scrub_mask != 1)
+    runs = [chunk for run in np.split(keep, np.flatnonzero(np.diff(keep) != 1) + 1) if len(run) > 0
+            for chunk in np.array_split(run, int(np.ceil(len(run) / chunk_frames)))]
+    masked_data = None
+    position = 0
+    for run in runs:
+        frames = img.dataobj[..., run[0]:run[-1] + 1]
+        if masked_data is None:
+            masked_data = np.empty(img.shape[:3] + (len(keep),), dtype=frames.dtype)
+        masked_data[..., position:position + len(run)] = frames
+        position += len(run)
+    if masked_data is None:
+        masked_data = np.empty(img.shape[:3] + (0,), dtype=img.get_data_dtype())
+    masked_img = nib.Nifti1Image(masked_data, affine=img.affine, header=img.header)
     nib.save(masked_img, str(out_p))
     return out_p.is_file()
+
+
+def _niak_stem(img_p):
+    # File name without the imaging extensions, e.g. fmri_sub1_session1_rest for fmri_sub1_session1_rest.nii.gz
+    name = pal.Path(img_p).name
+    for ext in ('.nii.gz', '.nii', '.mnc.gz', '.mnc'):
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return pal.Path(img_p).stem
+
+
+@unpacker
+def _niak_scrubbing_batch_job(img_p, extra_p, out_p, clobber, chunk_frames):
+    return niak_scrubbing(img_p, extra_p, out_p, clobber=clobber, chunk_frames=chunk_frames)
+
+
+def niak_scrubbing_batch(func_dir, out_dir, extra_dir=None, pattern='*.nii.gz', n_procs=1, clobber=False,
+                         chunk_frames=50):
+    """
+    Scrub every functional image in a folder. Each image <name>.nii.gz is paired with the NIAK scrubbing mask in
+    <name>_extra.mat.
+
+    :param func_dir: pathlib path to the folder with the functional images
+    :param out_dir: pathlib path to the folder of the scrubbed images. They keep their file name
+    :param extra_dir: pathlib path to the folder with the _extra.mat files. Defaults to func_dir
+    :param pattern: glob pattern of the functional images
+    :param n_procs: number of worker processes
+    :param clobber: if true, overwrite existing output image files
+    :param chunk_frames: maximum number of frames read from an image at a time
+    :return: dict of output path to True if the scrubbed image exists
+    """
+    func_dir = pal.Path(func_dir)
+    out_dir = pal.Path(out_dir)
+    extra_dir = func_dir if extra_dir is None else pal.Path(extra_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    jobs = list()
+    for img_p in sorted(func_dir.glob(pattern)):
+        extra_p = extra_dir / f'{_niak_stem(img_p)}_extra.mat'
+        if not extra_p.is_file():
+            warnings.warn(f'No scrubbing mask for {img_p.name}, expected {extra_p}. Skipping this image.')
+            continue
+        jobs.append({'img_p': img_p, 'extra_p': extra_p, 'out_p': out_dir / img_p.name, 'clobber': clobber,
+                     'chunk_frames': chunk_frames})
+    if n_procs == 1:
+        done = list(map(_niak_scrubbing_batch_job, jobs))
+    else:
+        with mp.Pool(n_procs) as pool:
+            done = pool.map(_niak_scrubbing_batch_job, jobs)
+    return {job['out_p']: status for job, status in zip(jobs, done)}
+
+
+def temporary_path(out_p):
+    """
+    :param out_p: pathlib path to an output file or folder
+    :return: pathlib path to a hidden temporary name next to out_p that is unique to this process, also across the
+             nodes of a cluster that share the file system
+    """
+    out_p = pal.Path(out_p)
+    return out_p.with_name(f'.{out_p.name}.{socket.gethostname()}.{os.getpid()}.tmp')
+
+
+def seed_store_path(seed_stack_p):
+    """
+    :param seed_stack_p: pathlib path to a (n_subjects, n_voxels, n_networks) .npy seed stack
+    :return: pathlib path of the matching network-major seed store
+    """
+    seed_stack_p = pal.Path(seed_stack_p)
+    return seed_stack_p.with_name(f'{seed_stack_p.stem}_by_network.npy')
+
+
+def write_seed_store(seed_stack, store_p, dtype=None, clobber=False):
+    """
+    Write a seed stack in network-major layout so that each network is one contiguous block on disk.
+
+    :param seed_stack: 3D array (n_subjects, n_voxels, n_networks) or pathlib path to such a .npy file. Paths are
+                       memory mapped and converted one network at a time
+    :param store_p: pathlib path to the output .npy file of shape (n_networks, n_subjects, n_voxels)
+    :param dtype: numpy dtype of the store. Defaults to the dtype of the seed stack
+    :param clobber: if true, overwrite an existing store
+    :return: pathlib path to the store
+    """
+    store_p = pal.Path(store_p)
+    if store_p.is_file() and not clobber:
+        warnings.warn(f'{store_p.name} already exists and clobber = {clobber}. Not touching anything:\n {store_p}')
+        return store_p
+    if not issubclass(type(seed_stack), np.ndarray):
+        seed_stack = np.load(str(seed_stack), mmap_mode='r')
+    n_subjects, n_voxels, n_networks = seed_stack.shape
+    dtype = seed_stack.dtype if dtype is None else dtype
+    # Write under a temporary name so that readers never see a half written store
+    tmp_p = temporary_path(store_p)
+    store = np.lib.format.open_memmap(str(tmp_p), mode='w+', dtype=dtype, shape=(n_networks, n_subjects, n_voxels))
+    for network_id in range(n_networks):
+        store[network_id] = seed_stack[..., network_id]
+    store.flush()
+    del store
+    os.replace(tmp_p, store_p)
+    return store_p
+
+
+def seed_store_is_current(seed_stack_p):
+    """
+    :param seed_stack_p: pathlib path to a (n_subjects, n_voxels, n_networks) .npy seed stack
+    :return: True if the network-major store of the seed stack exists and is not older than the stack
+    """
+    seed_stack_p = pal.Path(seed_stack_p)
+    store_p = seed_store_path(seed_stack_p)
+    return store_p.is_file() and store_p.stat().st_mtime >= seed_stack_p.stat().st_mtime
+
+
+def ensure_seed_store(seed_stack_p, dtype=None):
+    """
+    Build the network-major store next to the seed stack unless an up-to-date one exists
+
+    :param seed_stack_p: pathlib path to a (n_subjects, n_voxels, n_networks) .npy seed stack
+    :param dtype: numpy dtype of the store. Defaults to the dtype of the seed stack
+    :return: pathlib path to the store
+    """
+    seed_stack_p = pal.Path(seed_stack_p)
+    store_p = seed_store_path(seed_stack_p)
+    if seed_store_is_current(seed_stack_p):
+        return store_p
+    return write_seed_store(seed_stack_p, store_p, dtype=dtype, clobber=True)
+
+
+def open_seed_store(store_p):
+    """
+    Open a network-major seed store read-only and memory mapped. All processes that open the same store share one
+    copy in the page cache and store[network_id] only reads the pages of that network.
+
+    :param store_p: pathlib path to a store written by write_seed_store
+    :return: read-only numpy memmap of shape (n_networks, n_subjects, n_voxels)
+    """
+    return np.load(str(store_p), mmap_mode='r')
+
+
+RESULT_FIELDS = ('bootstrap_train', 'bootstrap_test', 'p_values', 'p0_values')
+
+
+def create_results_store(store_dir, n_replicates, n_subjects, n_networks, n_fields=len(RESULT_FIELDS)):
+    """
+    Create an empty results store unless one exists already. The store is a folder with two .npy files:
+    results.npy of shape (n_replicates, n_networks, n_fields, n_subjects), so that the results of one job are one
+    contiguous block on disk, and done.npy of shape (n_replicates, n_networks) that flags the finished jobs. Both
+    are written in a temporary folder that is then renamed, so when several processes create the same store at
+    once only the first one wins and the others keep its store.
+
+    :param store_dir: pathlib path to the store folder
+    :param n_replicates: number of replicates
+    :param n_subjects: number of subjects
+    :param n_networks: number of networks
+    :param n_fields: number of values stored per subject
+    :return: pathlib path to the store folder
+    """
+    store_dir = pal.Path(store_dir)
+    shape = (n_replicates, n_networks, n_fields, n_subjects)
+    if not store_dir.is_dir():
+        store_dir.parent.mkdir(parents=True, exist_ok=True)
+        tmp_dir = temporary_path(store_dir)
+        tmp_dir.mkdir()
+        results = np.lib.format.open_memmap(str(tmp_dir / 'results.npy'), mode='w+', dtype=float, shape=shape)
+        results[:] = np.nan
+        results.flush()
+        del results
+        np.save(str(tmp_dir / 'done.npy'), np.zeros(shape[:2], dtype=np.uint8))
+        try:
+            os.rename(tmp_dir, store_dir)
+        except OSError:
+            # Somebody else created the store in the meantime
+            for tmp_p in tmp_dir.iterdir():
+                tmp_p.unlink()
+            tmp_dir.rmdir()
+    stored_shape = np.load(str(store_dir / 'results.npy'), mmap_mode='r').shape
+    if not stored_shape == shape:
+        raise Exception(f'The results store at {store_dir} has shape {stored_shape} but {shape} was requested. '
+                        f'Remove it or use another folder')
+    return store_dir
+
+
+def _write_at(npy_p, flat_index, values):
+    # Write values at flat_index of the C ordered array in npy_p and make sure they are on disk
+    values = np.ascontiguousarray(values)
+    offset = np.load(str(npy_p), mmap_mode='r').offset
+    fd = os.open(npy_p, os.O_WRONLY)
+    try:
+        os.pwrite(fd, values.tobytes(), offset + flat_index * values.itemsize)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_results_block(store_dir, replicate_id, network_id, block):
+    """
+    Write the results of one job into a store. The block is written and synced to disk before the job is flagged
+    as done, so readers never see half written results and a job that dies halfway is simply run again. Jobs only
+    write their own bytes with plain positioned writes, so many processes, also on different nodes of a shared
+    file system, can write into the same store.
+
+    :param store_dir: pathlib path to a store made by create_results_store
+    :param replicate_id: int. 0-based replicate index
+    :param network_id: int. 0-based network index
+    :param block: 2D array (n_fields, n_subjects)
+    :return: None
+    """
+    store_dir = pal.Path(store_dir)
+    results = np.load(str(store_dir / 'results.npy'), mmap_mode='r')
+    block = np.asarray(block, dtype=results.dtype)
+    if not block.shape == results.shape[2:]:
+        raise Exception(f'Block has shape {block.shape} but the store expects {results.shape[2:]}')
+    n_replicates, n_networks = results.shape[:2]
+    del results
+    if not (0 <= replicate_id < n_replicates and 0 <= network_id < n_networks):
+        raise Exception(f'Job ({replicate_id}, {network_id}) is outside of the store of {n_replicates} replicates '
+                        f'and {n_networks} networks')
+    job_id = replicate_id * n_networks + network_id
+    _write_at(store_dir / 'results.npy', job_id * block.size, block)
+    _write_at(store_dir / 'done.npy', job_id, np.ones(1, dtype=np.uint8))
+
+
+def open_results_store(store_dir):
+    """
+    Open a results store read-only and memory mapped
+
+    :param store_dir: pathlib path to a store made by create_results_store
+    :return: tuple of the results as a (n_replicates, n_subjects, n_fields, n_networks) view of the memory map and
+             the (n_replicates, n_networks) boolean array of finished jobs. Results of unfinished jobs are NaN
+    """
+    store_dir = pal.Path(store_dir)
+    results = np.load(str(store_dir / 'results.npy'), mmap_mode='r')
+    done = np.load(str(store_dir / 'done.npy')).astype(bool)
+    return results.transpose(0, 3, 2, 1), done
@@ -0,0 +1,185 @@
+import numpy as np
+
+# Constants used by glm.fit / binomial() so we can reproduce the R scripts exactly
+R_DBL_EPSILON = np.finfo(float).eps
+R_LOGIT_THRESH = 30.
+R_GLM_EPSILON = 1e-8
+R_GLM_MAXIT = 25
+EPS_VAL = 1e-16
+
+
+def _logit_linkinv(eta):
+    tmp = np.where(eta < -R_LOGIT_THRESH, R_DBL_EPSILON,
+                   np.where(eta > R_LOGIT_THRESH, 1 / R_DBL_EPSILON, np.exp(np.clip(eta, -R_LOGIT_THRESH,
+                                                                                    R_LOGIT_THRESH))))
+    return tmp / (1 + tmp)
+
+
+def _logit_mu_eta(eta):
+    opexp = 1 + np.exp(np.clip(eta, -R_LOGIT_THRESH, R_LOGIT_THRESH))
+    return np.where(np.abs(eta) > R_LOGIT_THRESH, R_DBL_EPSILON,
+                    np.exp(np.clip(eta, -R_LOGIT_THRESH, R_LOGIT_THRESH)) / (opexp * opexp))
+
+
+def _binomial_deviance(y, mu, axis=None):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dev = 2 * (np.where(y > 0, y * np.log(y / mu), 0) + np.where(1 - y > 0, (1 - y) * np.log((1 - y) / (1 - mu)), 0))
+    return np.sum(dev, axis=axis)
+
+
+def _linear_predictor(design, coef):
+    # design @ coef accumulated one column at a time like the reference BLAS used by R. Identical rows, e.g. a subject
+    # drawn twice by the bootstrap, then get bit-identical predictors, which the tie counting of the p-values needs.
+    # Optimized BLAS kernels can round identical rows differently depending on their position
+    eta = design[..., 0] * coef[..., 0, None]
+    for col_id in range(1, design.shape[-1]):
+        eta = eta + design[..., col_id] * coef[..., col_id, None]
+    return eta
+
+
+def glm_logit_fit(design, y):
+    """
+    Logistic regression by iteratively reweighted least squares, following glm.fit(..., family=binomial())
+
+    :param design: 2D array (n_samples, n_features). Include the intercept column yourself
+    :param y: 1D array of 0/1 labels
+    :return: 1D array of linear predictors at convergence
+    """
+    mu = (y + 0.5) / 2
+    eta = np.log(mu / (1 - mu))
+    dev_old = _binomial_deviance(y, _logit_linkinv(eta))
+    for _ in range(R_GLM_MAXIT):
+        mu_eta = _logit_mu_eta(eta)
+        good = mu_eta != 0
+        z = eta[good] + (y - mu)[good] / mu_eta[good]
+        w = np.sqrt(mu_eta[good] ** 2 / (mu * (1 - mu))[good])
+        coef = np.linalg.lstsq(design[good] * w[:, None], z * w, rcond=None)[0]
+        eta = _linear_predictor(design, coef)
+        mu = _logit_linkinv(eta)
+        dev = _binomial_deviance(y, mu)
+        if np.abs(dev - dev_old) / (np.abs(dev) + 0.1) < R_GLM_EPSILON:
+            break
+        dev_old = dev
+    return eta
+
+
+def batched_logit_fit(designs, y, eta_start=None):
+    """
+    Many small logistic regressions fit at once by the IRLS of glm_logit_fit. Every problem iterates until it
+    converges on its own, after which it is left out of the remaining iterations.
+
+    :param designs: 3D array (n_problems, n_samples, n_features). Include the intercept column yourself
+    :param y: 2D array (n_problems, n_samples) of 0/1 labels
+    :param eta_start: optional 2D array (n_problems, n_samples) of linear predictors to start from, like the etastart
+                      argument of glm.fit. None starts from the labels like glm.fit does by default
+    :return: tuple of the 2D array of linear predictors at convergence and the 1D number of iterations per problem
+    """
+    designs = np.asarray(designs, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if eta_start is None:
+        mu = (y + 0.5) / 2
+        eta = np.log(mu / (1 - mu))
+    else:
+        eta = np.array(eta_start, dtype=float)
+        mu = _logit_linkinv(eta)
+    dev_old = _binomial_deviance(y, _logit_linkinv(eta), axis=-1)
+    n_iter = np.zeros(designs.shape[0], dtype=int)
+    active = np.arange(designs.shape[0])
+    for _ in range(R_GLM_MAXIT):
+        if active.size == 0:
+            break
+        y_a, eta_a, mu_a = y[active], eta[active], mu[active]
+        mu_eta = _logit_mu_eta(eta_a)
+        # Observations with a zero derivative get zero weight, which is the same as leaving them out
+        good = mu_eta != 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            z = np.where(good, eta_a + (y_a - mu_a) / mu_eta, 0)
+            w = np.where(good, np.sqrt(mu_eta ** 2 / (mu_a * (1 - mu_a))), 0)
+        # Weighted least squares of all active problems at once
+        eta_a = _linear_predictor(designs[active], _batched_coef(designs[active] * w[..., None], z * w))
+        mu_a = _logit_linkinv(eta_a)
+        dev = _binomial_deviance(y_a, mu_a, axis=-1)
+        eta[active], mu[active] = eta_a, mu_a
+        n_iter[active] += 1
+        converged = np.abs(dev - dev_old[active]) / (np.abs(dev) + 0.1) < R_GLM_EPSILON
+        dev_old[active] = dev
+        active = active[~converged]
+    return eta, n_iter
+
+
+def _batched_coef(designs, z):
+    # Least squares coefficients of many problems (n_problems, n_samples, n_features) as (n_problems, n_features).
+    # Well conditioned problems are solved by one batched QR, rank deficient ones fall back to the minimum norm
+    # lstsq solution
+    q, r = np.linalg.qr(designs)
+    diag = np.abs(np.diagonal(r, axis1=-2, axis2=-1))
+    deficient = np.any(diag <= 1e-10 * np.max(diag, -1, keepdims=True), -1)
+    coef = np.empty((designs.shape[0], designs.shape[2]))
+    ok = ~deficient
+    if np.any(ok):
+        coef[ok] = np.linalg.solve(r[ok], np.swapaxes(q[ok], -1, -2) @ z[ok][..., None])[..., 0]
+    for problem_id in np.flatnonzero(deficient):
+        coef[problem_id] = np.linalg.lstsq(designs[problem_id], z[problem_id], rcond=None)[0]
+    return coef
+
+
+def conformal_alpha(eta, y):
+    """
+    :param eta: array of linear predictors (..., n_samples)
+    :param y: 0/1 labels of the same shape
+    :return: nonconformity scores of the R scripts: -eta * EPS_VAL for label 1 and eta for label 0
+    """
+    return np.where(y == 1, -eta * EPS_VAL, eta)
+
+
+def conformal_p_value(design, y_train, label):
+    """
+    Conformal p-value of the last row in design when it is given the candidate label
+
+    :param design: 2D array (n_train + 1, n_features). The test subject is the last row
+    :param y_train: 1D array of 0/1 labels of the training subjects
+    :param label: 0 or 1. The candidate label of the test subject
+    :return: float
+    """
+    y = np.append(y_train, label).astype(float)
+    eta = glm_logit_fit(design, y)
+    alpha_list = conformal_alpha(eta, y)
+    return np.mean(alpha_list > alpha_list[-1]) + np.mean(alpha_list == alpha_list[-1])
+
+
+def _p_from_alpha(alpha_list):
+    # Batched version of the p-value of conformal_p_value, for the last sample of each problem
+    return (np.mean(alpha_list > alpha_list[:, -1:], -1) +
+            np.mean(alpha_list == alpha_list[:, -1:], -1))
+
+
+def conformal_p_values(designs, y_train, warm_start=True):
+    """
+    Conformal p-values of many test subjects at once. Each test subject is the last row of its own design and is
+    fit once with label 1 (p value) and once with label 0 (p0 value), with the same definitions as
+    conformal_p_value.
+
+    :param designs: 3D array (n_test, n_train + 1, n_features). The test subject is the last row of each design
+    :param y_train: 1D array of 0/1 labels of the training subjects, or 2D (n_test, n_train) if they differ
+    :param warm_start: if True, start the label 0 fits from the label 1 solutions. They converge in fewer iterations
+                       to the same tolerance, so scores can move by about the convergence tolerance. Fits that end
+                       with a higher deviance than they started from or do not converge start again from the labels.
+                       If False, both start like glm.fit and match conformal_p_value
+    :return: tuple of 1D arrays (p_values, p0_values)
+    """
+    designs = np.asarray(designs, dtype=float)
+    y_train = np.broadcast_to(np.asarray(y_train, dtype=float), designs.shape[:1] + (designs.shape[1] - 1,))
+    y1 = np.concatenate([y_train, np.ones((designs.shape[0], 1))], 1)
+    y0 = np.concatenate([y_train, np.zeros((designs.shape[0], 1))], 1)
+    eta1, _ = batched_logit_fit(designs, y1)
+    if warm_start:
+        eta0, n_iter = batched_logit_fit(designs, y0, eta_start=eta1)
+        # Without step halving, flipping the label of the test subject can make the warm started IRLS diverge
+        diverged = ((n_iter >= R_GLM_MAXIT) |
+                    ~(_binomial_deviance(y0, _logit_linkinv(eta0), axis=-1) <=
+                      _binomial_deviance(y0, _logit_linkinv(eta1), axis=-1)))
+        if np.any(diverged):
+            eta0[diverged], _ = batched_logit_fit(designs[diverged], y0[diverged])
+    else:
+        eta0, _ = batched_logit_fit(designs, y0)
+    return _p_from_alpha(conformal_alpha(eta1, y1)), _p_from_alpha(conformal_alpha(eta0, y0))
@@ -0,0 +1,146 @@
+import os
+import numpy as np
+import pandas as pd
+import pathlib as pal
+import multiprocessing as mp
+from .logistic import batched_logit_fit, conformal_alpha
+from .conformal import N_REPLICATES, r_bootstrap_indices, write_results_csv
+
+
+def null_result_path(output_dir, random_seed):
+    return pal.Path(output_dir) / f'Results_Instance_{random_seed}_NULL_Model_age_fd.csv'
+
+
+def null_bootstrap_indices(random_seeds, n_subjects):
+    """
+    Bootstrap samples of Null_Model.R for many seeds at once
+
+    :param random_seeds: iterable of int. Seeds passed to set.seed
+    :param n_subjects: int. Number of subjects in the phenotype table
+    :return: tuple of 2D integer arrays (n_seeds, n_subjects) of bootstrap_train and bootstrap_test, 1-based like in R
+    """
+    indices = [r_bootstrap_indices(random_seed, n_subjects) for random_seed in random_seeds]
+    return (np.array([train for train, _ in indices], dtype=int).reshape(-1, n_subjects),
+            np.array([test for _, test in indices], dtype=int).reshape(-1, n_subjects))
+
+
+def _null_p_from_alpha(alpha_list):
+    # Null_Model.R compares alpha_list with alpha_list[dim(regressed_vars_i)], which are the scores of the test
+    # subject (last) and of the third training subject. R recycles these two over alpha_list, so the subjects at odd
+    # positions are compared with the test subject and those at even positions with the third subject
+    n_samples = alpha_list.shape[-1]
+    reference = alpha_list[..., [n_samples - 1, 2]][..., np.arange(n_samples) % 2]
+    return np.mean(alpha_list > reference, -1) + np.mean(alpha_list == reference, -1)
+
+
+def null_scores(regressed_vars, classes_var, bootstrap_train, bootstrap_test):
+    """
+    Conformal scores of the covariate-only null model of Null_Model.R, for many bootstrap replicates at once. The
+    logistic regressions of all test subjects of all replicates are fit together by the batched IRLS
+
+    :param regressed_vars: 2D array (n_subjects, n_factors) of nuisance design, including the intercept
+    :param classes_var: 1D array of 0/1 labels (1 = autism)
+    :param bootstrap_train: 2D array (n_replicates, n_train) of 1-based indices of the training subjects
+    :param bootstrap_test: 2D array (n_replicates, n_test) of 1-based indices of the test subjects
+    :return: tuple of 2D arrays (n_replicates, n_test) of p_values and p0_values
+    """
+    train = np.asarray(bootstrap_train) - 1
+    test = np.asarray(bootstrap_test) - 1
+    n_replicates, n_test = test.shape
+    # One (n_train + 1) x n_factors design per test subject and replicate, the test subject last
+    subjects = np.concatenate([np.repeat(train[:, None, :], n_test, 1), test[..., None]], -1)
+    designs = regressed_vars[subjects].reshape(n_replicates * n_test, train.shape[1] + 1, -1)
+    y_train = np.repeat(classes_var[train], n_test, 0)
+    p_list = list()
+    for label in [1, 0]:
+        y = np.concatenate([y_train, np.full((y_train.shape[0], 1), label)], 1).astype(float)
+        eta, _ = batched_logit_fit(designs, y)
+        p_list.append(_null_p_from_alpha(conformal_alpha(eta, y)).reshape(n_replicates, n_test))
+    return tuple(p_list)
+
+
+def load_null_data(source_dir, debug=False):
+    """
+    :param source_dir: path to the folder with ABIDE1_Pheno_PSM_matched.tsv
+    :param debug: if True, only keep the first 20 subjects of the phenotype table
+    :return: tuple of (regressed_vars, classes_var)
+    """
+    pheno = pd.read_csv(pal.Path(source_dir) / 'ABIDE1_Pheno_PSM_matched.tsv', sep='\t')
+    if debug:
+        pheno = pheno.iloc[:20]
+    regressed_vars = np.column_stack([np.ones(len(pheno)), pheno['AGE_AT_SCAN'].values,
+                                      pheno['fd_scrubbed'].values]).astype(float)
+    classes_var = np.where(pheno['DX_GROUP'].values == 'Control', 0, 1)
+    return regressed_vars, classes_var
+
+
+def run_null_block(regressed_vars, classes_var, random_seeds, bootstrap_train, bootstrap_test, output_dir):
+    """
+    Python equivalent of the replicates of Null_Model.R for a block of seeds. Writes one
+    Results_Instance_{seed}_NULL_Model_age_fd.csv file per seed, with the same content as the R script
+
+    :param regressed_vars: 2D nuisance design (n_subjects, n_factors)
+    :param classes_var: 1D array of 0/1 labels
+    :param random_seeds: list of int. The seeds of the block
+    :param bootstrap_train: 2D array (n_seeds, n_subjects) of bootstrap training samples, see null_bootstrap_indices
+    :param bootstrap_test: 2D array (n_seeds, n_subjects) of bootstrap testing samples
+    :param output_dir: path to the output folder
+    :return: list of pathlib paths to the results files
+    """
+    p_values, p0_values = null_scores(regressed_vars, classes_var, bootstrap_train, bootstrap_test)
+    out_list = list()
+    for seed_id, random_seed in enumerate(random_seeds):
+        out_p = null_result_path(output_dir, random_seed)
+        write_results_csv(out_p, bootstrap_train[seed_id], bootstrap_test[seed_id], p_values[seed_id],
+                          p0_values[seed_id])
+        out_list.append(out_p)
+    return out_list
+
+
+# State of a null model worker process, loaded once in _init_null_worker
+_null_worker = dict()
+
+
+def _init_null_worker(source_dir, output_dir, debug):
+    from threadpoolctl import threadpool_limits
+    # Limit internal threading to 1 to avoid nested parallelism
+    threadpool_limits(1)
+    _null_worker['data'] = load_null_data(source_dir, debug)
+    _null_worker['output_dir'] = output_dir
+
+
+def _run_null_job(job):
+    random_seeds, bootstrap_train, bootstrap_test = job
+    out_list = run_null_block(*_null_worker['data'], random_seeds, bootstrap_train, bootstrap_test,
+                              _null_worker['output_dir'])
+    return random_seeds, [str(out_p) for out_p in out_list]
+
+
+def run_null_jobs(source_dir, output_dir, random_seeds=None, debug=False, n_procs=1, seeds_per_job=4):
+    """
+    Run the null model replicates in worker processes. The bootstrap samples of all seeds are drawn up front, then
+    blocks of seeds_per_job seeds are fit together by one worker. Seeds with a results file are skipped
+
+    :param source_dir: path to the source data folder
+    :param output_dir: path to the output folder
+    :param random_seeds: iterable of int. Defaults to 1 to N_REPLICATES, or only 1 in debug mode like the R script
+    :param debug: if True, only use the first 20 subjects and the first seed
+    :param n_procs: number of worker processes
+    :param seeds_per_job: number of seeds fit together. Memory use grows with seeds_per_job x n_subjects^2
+    :return: list of (seeds, output paths) for the blocks of seeds that were run
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    if random_seeds is None:
+        random_seeds = range(1, 2 if debug else N_REPLICATES + 1)
+    random_seeds = [seed for seed in random_seeds if not null_result_path(output_dir, seed).is_file()]
+    if not random_seeds:
+        return []
+    n_subjects = len(load_null_data(source_dir, debug)[1])
+    bootstrap_train, bootstrap_test = null_bootstrap_indices(random_seeds, n_subjects)
+    jobs = [(random_seeds[start:start + seeds_per_job], bootstrap_train[start:start + seeds_per_job],
+             bootstrap_test[start:start + seeds_per_job]) for start in range(0, len(random_seeds), seeds_per_job)]
+    if n_procs == 1:
+        _init_null_worker(source_dir, output_dir, debug)
+        return [_run_null_job(job) for job in jobs]
+    with mp.Pool(n_procs, initializer=_init_null_worker, initargs=(source_dir, output_dir, debug)) as pool:
+        return list(pool.imap_unordered(_run_null_job, jobs))
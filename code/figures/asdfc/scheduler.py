@@ -0,0 +1,250 @@
+import os
+import math
+import time
+import subprocess
+import pathlib as pal
+import concurrent.futures as cf
+import pandas as pd
+from .data import ensure_seed_store, seed_store_is_current
+from .conformal import N_REPLICATES, N_NETWORKS, existing_discovery_results, discovery_n_subjects, \
+    discovery_store_dir, ensure_discovery_store, consolidate_discovery_results, _init_discovery_worker, \
+    _run_discovery_job
+
+TIMING_FILE = 'discovery_timings.tsv'
+TIMING_COLUMNS = ['replicate', 'network', 'engine', 'attempt', 'seconds', 'status']
+
+
+def discovery_job_graph(output_dir, replicates=None, networks=None):
+    """
+    All discovery jobs that still have to run. The jobs are independent of each other and only depend on the
+    network-major seed store and the results store, which the schedulers build once before any job starts.
+
+    :param output_dir: path to the discovery output folder
+    :param replicates: iterable of 1-based replicates. Defaults to all N_REPLICATES
+    :param networks: iterable of 1-based networks. Defaults to all N_NETWORKS
+    :return: list of (replicate, network) tuples without results in output_dir, see
+             conformal.existing_discovery_results
+    """
+    replicates = range(1, N_REPLICATES + 1) if replicates is None else replicates
+    networks = range(1, N_NETWORKS + 1) if networks is None else list(networks)
+    done = existing_discovery_results(output_dir)
+    return [(rep, net) for rep in replicates for net in networks if (rep, net) not in done]
+
+
+def read_job_timings(timing_p):
+    """
+    :param timing_p: pathlib path to a timing table written by run_discovery_schedule
+    :return: pandas DataFrame with TIMING_COLUMNS, empty if there is no table yet
+    """
+    timing_p = pal.Path(timing_p)
+    if not timing_p.is_file():
+        return pd.DataFrame(columns=TIMING_COLUMNS)
+    timings = pd.read_csv(timing_p, sep='\t', dtype=str)
+    # Tables written before the header was created atomically can repeat the header in the middle
+    timings = timings[~(timings[TIMING_COLUMNS] == TIMING_COLUMNS).all(1)]
+    for col in ['replicate', 'network', 'attempt']:
+        timings[col] = pd.to_numeric(timings[col], errors='coerce').astype('Int64')
+    timings['seconds'] = pd.to_numeric(timings['seconds'], errors='coerce')
+    return timings.reset_index(drop=True)
+
+
+def order_jobs_longest_first(jobs, timings=None, engine=None):
+    """
+    Sort the jobs by expected run time, longest first, so the slowest jobs don't end up alone at the end of a run.
+    The expected run time of a job is the median time of the successful jobs of the same network in past runs.
+    Networks that were never timed go first.
+
+    :param jobs: list of (replicate, network) tuples
+    :param timings: pandas DataFrame of past timings, see read_job_timings. None keeps the order of jobs
+    :param engine: if given, only use the timings of this engine
+    :return: list of (replicate, network) tuples
+    """
+    if timings is None or timings.empty:
+        return list(jobs)
+    timings = timings[timings['status'] == 'ok']
+    if engine is not None:
+        timings = timings[timings['engine'] == engine]
+    expected = timings.groupby('network')['seconds'].median().to_dict()
+    # sorted is stable, so jobs with the same expected time keep their order
+    return sorted(jobs, key=lambda job: -expected.get(job[1], math.inf))
+
+
+def _append_timing(timing_p, job, engine, attempt, seconds, status):
+    # One short write per job, so the array tasks of a SLURM run can all append to the same table. Only the process
+    # that creates the file writes the header, the others find it with O_EXCL
+    try:
+        fd = os.open(timing_p, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_APPEND)
+        os.write(fd, ('\t'.join(TIMING_COLUMNS) + '\n').encode())
+        os.close(fd)
+    except FileExistsError:
+        pass
+    line = '\t'.join(map(str, [*job, engine, attempt, f'{seconds:.3f}', status])) + '\n'
+    with open(timing_p, 'a') as f:
+        f.write(line)
+
+
+# Arguments of an Rscript worker process, set once in _init_rscript_worker
+_rscript_worker = dict()
+
+
+def _init_rscript_worker(source_dir, output_dir, debug):
+    _rscript_worker['source_dir'] = source_dir
+    _rscript_worker['output_dir'] = output_dir
+    _rscript_worker['debug'] = debug
+
+
+def _run_rscript_job(job):
+    # Same call as run_discovery with engine="r", without going through invoke
+    replicate, network = job
+    output_dir = os.path.relpath(_rscript_worker['output_dir'])
+    subprocess.run(['Rscript', 'code/data_analysis/discovery_conformal_score.R', str(replicate), str(replicate),
+                    str(network), str(_rscript_worker['source_dir']), f'./{output_dir}',
+                    'TRUE' if _rscript_worker['debug'] else 'FALSE'], check=True)
+    return replicate, network
+
+
+ENGINES = {'python': (_init_discovery_worker, _run_discovery_job),
+           'r': (_init_rscript_worker, _run_rscript_job)}
+
+
+def _timed_job(job_func, job):
+    # Runs in the worker. Errors are returned instead of raised so the scheduler can retry the job
+    start = time.perf_counter()
+    try:
+        job_func(job)
+        error = None
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+    return job, time.perf_counter() - start, error
+
+
+def run_discovery_schedule(jobs, source_dir, output_dir, engine='python', debug=False, n_procs=1, retries=1,
+                           verbose=True, build_stores=True):
+    """
+    Run discovery jobs on a bounded pool of worker processes. Jobs start in the given order, see
+    order_jobs_longest_first, each job is timed and a failed job is queued again up to retries times. Every
+    attempt is appended to the TIMING_FILE table in output_dir, which the ordering of later runs uses. The results
+    of both engines end up in the results store of output_dir, see conformal.consolidate_discovery_results.
+
+    :param jobs: list of (replicate, network) tuples, both 1-based. The replicate is also the random seed
+    :param source_dir: path to the source data folder
+    :param output_dir: path to the output folder
+    :param engine: "python" for the asdfc conformal engine, "r" for discovery_conformal_score.R
+    :param debug: if True, only use the first 20 subjects
+    :param n_procs: number of worker processes
+    :param retries: number of times a failed job is run again
+    :param verbose: if True, print one progress line per finished attempt and a summary
+    :param build_stores: if True, build the seed store and the results store when they are missing or out of
+                         date. If False, only check that they are ready, e.g. in the tasks of a SLURM array that
+                         all start at once and would otherwise all write the same stores
+    :return: list of (replicate, network) tuples of the jobs that were run
+    """
+    if engine not in ENGINES:
+        raise Exception(f'Unknown discovery engine {engine}. Use one of {list(ENGINES)}')
+    init_func, job_func = ENGINES[engine]
+    jobs = list(jobs)
+    if not jobs:
+        return []
+    os.makedirs(output_dir, exist_ok=True)
+    timing_p = pal.Path(output_dir) / TIMING_FILE
+    seed_stack_p = pal.Path(source_dir) / 'seed_maps_no_cereb.npy'
+    if build_stores:
+        # Build the stores before the workers start so they don't race to write them
+        ensure_seed_store(seed_stack_p)
+        ensure_discovery_store(output_dir, discovery_n_subjects(source_dir, debug),
+                               max(N_REPLICATES, max(rep for rep, _ in jobs)))
+    elif not (seed_store_is_current(seed_stack_p) and discovery_store_dir(output_dir).is_dir()):
+        raise Exception(f'The seed store of {seed_stack_p} or the results store in {output_dir} is missing or out '
+                        f'of date. Build them once before starting the jobs, e.g. with invoke export-discovery-array')
+
+    attempts = dict()
+    done = list()
+    failed = dict()
+    job_seconds = 0.
+    start = time.perf_counter()
+
+    def record(result):
+        # Returns True if the job has to run again
+        nonlocal job_seconds
+        job, seconds, error = result
+        attempts[job] = attempts.get(job, 0) + 1
+        job_seconds += seconds
+        _append_timing(timing_p, job, engine, attempts[job], seconds, 'ok' if error is None else 'failed')
+        retry = error is not None and attempts[job] <= retries
+        if error is None:
+            done.append(job)
+        elif not retry:
+            failed[job] = error
+        if verbose:
+            n_finished = len(done) + len(failed)
+            left = (len(jobs) - n_finished) * job_seconds / max(sum(attempts.values()), 1) / n_procs
+            status = 'ok' if error is None else f'failed ({error}){", retrying" if retry else ""}'
+            print(f'[{n_finished}/{len(jobs)}] replicate {job[0]}, network {job[1]}: {seconds:.1f} s, {status}. '
+                  f'About {left / 60:.0f} min left')
+        return retry
+
+    if n_procs == 1:
+        init_func(source_dir, output_dir, debug)
+        for job in jobs:
+            while record(_timed_job(job_func, job)):
+                pass
+    else:
+        with cf.ProcessPoolExecutor(n_procs, initializer=init_func,
+                                    initargs=(source_dir, output_dir, debug)) as pool:
+            # The pool starts the jobs in submission order and a retried job goes to the back of the queue
+            pending = {pool.submit(_timed_job, job_func, job) for job in jobs}
+            while pending:
+                finished, pending = cf.wait(pending, return_when=cf.FIRST_COMPLETED)
+                for future in finished:
+                    if record(future.result()):
+                        pending.add(pool.submit(_timed_job, job_func, future.result()[0]))
+
+    # The R engine writes one .csv file per job. Only move the files of this schedule, other array tasks may still
+    # be writing theirs
+    consolidate_discovery_results(output_dir, jobs=done)
+    if verbose:
+        wall = time.perf_counter() - start
+        print(f'{len(done)} jobs done, {len(failed)} failed in {wall / 60:.1f} min on {n_procs} '
+              f'process{"es" if n_procs != 1 else ""} ({job_seconds / max(sum(attempts.values()), 1):.1f} s per '
+              f'attempt, {job_seconds / max(wall * n_procs, 1e-9):.0%} busy)')
+    if failed:
+        raise Exception(f'{len(failed)} discovery jobs failed after {retries + 1} attempts: ' +
+                        '; '.join(f'replicate {rep}, network {net}: {error}' for (rep, net), error in failed.items()))
+    return done
+
+
+def write_slurm_array(jobs, jobs_p, jobs_per_task=1, max_running=None):
+    """
+    Write the jobs as the task list of a SLURM job array. Line i of the file lists the jobs of array task i as
+    space separated replicate:network pairs. The jobs are dealt to the tasks in turn, so with jobs ordered by
+    order_jobs_longest_first every task gets a similar share of long and short jobs.
+
+    :param jobs: list of (replicate, network) tuples, both 1-based
+    :param jobs_p: pathlib path to the task list
+    :param jobs_per_task: number of jobs run one after the other by one array task
+    :param max_running: maximum number of array tasks running at once. None for no limit
+    :return: the specification to pass to sbatch --array, e.g. "0-99%20", or None if there are no jobs
+    """
+    jobs_p = pal.Path(jobs_p)
+    jobs = list(jobs)
+    if not jobs:
+        return None
+    n_tasks = math.ceil(len(jobs) / jobs_per_task)
+    lines = [' '.join(f'{rep}:{net}' for rep, net in jobs[task_id::n_tasks]) for task_id in range(n_tasks)]
+    jobs_p.parent.mkdir(parents=True, exist_ok=True)
+    tmp_p = jobs_p.with_name(f'.{jobs_p.name}.{os.getpid()}.tmp')
+    with open(tmp_p, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmp_p, jobs_p)
+    return f'0-{n_tasks - 1}' + (f'%{max_running}' if max_running else '')
+
+
+def read_slurm_array_task(jobs_p, task_id):
+    """
+    :param jobs_p: pathlib path to a task list written by write_slurm_array
+    :param task_id: int. The SLURM_ARRAY_TASK_ID of the array task
+    :return: list of (replicate, network) tuples of this task
+    """
+    with open(jobs_p) as f:
+        lines = f.read().splitlines()
+    return [tuple(int(val) for val in pair.split(':')) for pair in lines[int(task_id)].split()]
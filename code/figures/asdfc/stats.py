@@ -1,38 +1,118 @@
+import hashlib
 import warnings
+import collections
 import numpy as np
 import scipy as sp
 from scipy import cluster as scl
-from nilearn import input_data as nid
-from sklearn import linear_model as sln
+from scipy.spatial import distance as ssd
+from nilearn import image as nimg
 from sklearn import preprocessing as skp
 
+# Floating point type of data, residuals and correlations computed in this module. Means, sums of squares and
+# distances are always accumulated in float64. Use set_compute_dtype(np.float32) (or the dtype argument of the
+# functions below) to halve memory traffic and check the effect on your data with compare_compute_dtype.
+COMPUTE_DTYPE = np.float64
+# Number of subtype trees kept by subtype_tree. Trees are looked up by the content of the data, so repeated partitions
+# of the same data with different thresholds reuse the same linkage
+TREE_CACHE_SIZE = 64
+_tree_cache = collections.OrderedDict()
 
-def pearson_r(data, pheno, covariate_name):
+
+def set_compute_dtype(dtype):
+    """
+    :param dtype: np.float32 or np.float64. Default floating point type of the functions in this module
+    :return: the previous default
+    """
+    global COMPUTE_DTYPE
+    if np.dtype(dtype) not in (np.dtype(np.float32), np.dtype(np.float64)):
+        raise Exception(f'The compute dtype must be float32 or float64, not {dtype}')
+    previous = COMPUTE_DTYPE
+    COMPUTE_DTYPE = np.dtype(dtype).type
+    return previous
+
+
+def get_compute_dtype(dtype=None):
+    """
+    :param dtype: per call dtype, or None to use the module default
+    :return: numpy dtype
+    """
+    return np.dtype(COMPUTE_DTYPE if dtype is None else dtype)
+
+
+def covariate_mask(pheno, covariate_name):
+    """
+    :param pheno: pandas DataFrame with one row per subject
+    :param covariate_name: column of the covariate
+    :return: boolean mask of the subjects without a missing covariate. Compute it once and pass it to pearson_r for
+             every map that is correlated with the same covariate
+    """
+    return ~pheno[covariate_name].isnull().values
+
+
+def pearson_r(data, pheno, covariate_name, mask=None):
+    """
+    :param data: 1D array (n_subjects) or a stack of maps (n_subjects, ...) that are correlated element by element
+    :param pheno: pandas DataFrame with one row per subject, in the order of data
+    :param covariate_name: column of the covariate
+    :param mask: precomputed covariate_mask. None computes it
+    :return: dict with the correlations and their p values, of shape data.shape[1:] for stacks
+    """
     # Remove missing values
-    mask = ~pheno[covariate_name].isnull().values
+    if mask is None:
+        mask = covariate_mask(pheno, covariate_name)
     covariate = pheno[covariate_name]
     contrast_name = f'Pearson_r with {covariate_name}'
-    r, p = sp.stats.pearsonr(data[mask], covariate[mask])
+    if np.ndim(data) == 1:
+        r, p = sp.stats.pearsonr(data[mask], covariate[mask])
+    else:
+        data = np.asarray(data)
+        flat = data[mask].reshape(np.sum(mask), -1)
+        r, p = sp.stats.pearsonr(flat, covariate.values[mask][:, None], axis=0)
+        r, p = r.reshape(data.shape[1:]), p.reshape(data.shape[1:])
     result = {'pearson_r': r,
               'p': p,
               'contrast': contrast_name}
     return result
 
 
-def t_test(data, pheno, group, case, control):
+def group_indices(pheno, group, case, control):
+    """
+    :param pheno: pandas DataFrame with one row per subject
+    :param group: column of the group labels
+    :param case: label of the cases
+    :param control: label of the controls
+    :return: positions of the cases and of the controls in pheno. Compute them once and pass them to t_test for
+             every map of the same contrast
+    """
     # We cannot assume that the index is reset or consecutive from 0,
-    # Let's instead get the precise position
-    case_idx = np.array([pheno.index.get_loc(idx) for idx in pheno.query(f'{group} == "{case}"').index.values])
-    control_idx = np.array([pheno.index.get_loc(idx) for idx in pheno.query(f'{group} == "{control}"').index.values])
+    # so we get the precise position
+    labels = pheno[group].values
+    return np.flatnonzero(labels == case), np.flatnonzero(labels == control)
+
+
+def t_test(data, pheno, group, case, control, group_idx=None):
+    """
+    :param data: 1D array (n_subjects) or a stack of maps (n_subjects, ...) that are tested element by element
+    :param pheno: pandas DataFrame with one row per subject, in the order of data
+    :param group: column of the group labels
+    :param case: label of the cases
+    :param control: label of the controls
+    :param group_idx: precomputed (case_idx, control_idx) from group_indices. None computes them
+    :return: dict with the statistics, of shape data.shape[1:] for stacks
+    """
+    if group_idx is None:
+        group_idx = group_indices(pheno, group, case, control)
+    case_idx, control_idx = group_idx
     contrast_name = f'T_Test     of {group}: {case} vs {control}'
 
+    data = np.asarray(data)
     n_case = len(case_idx)
     n_control = len(control_idx)
-    t, p = sp.stats.ttest_ind(data[case_idx], data[control_idx])
-    mean_case = np.mean(data[case_idx])
-    mean_control = np.mean(data[control_idx])
-    pooled_std = np.sqrt((((n_case - 1) * np.square(np.std(data[case_idx]))) +
-                         ((n_control - 1) * np.square(np.std(data[case_idx])))) / (n_case + n_control - 2))
+    t, p = sp.stats.ttest_ind(data[case_idx], data[control_idx], axis=0)
+    mean_case = np.mean(data[case_idx], 0)
+    mean_control = np.mean(data[control_idx], 0)
+    pooled_std = np.sqrt((((n_case - 1) * np.square(np.std(data[case_idx], 0))) +
+                         ((n_control - 1) * np.square(np.std(data[case_idx], 0)))) / (n_case + n_control - 2))
     cohens = (mean_case - mean_control) / pooled_std
     results = {'t': t,
                'p': p,
@@ -44,56 +124,586 @@ def t_test(data, pheno, group, case, control):
     return results
 
 
-def corr2_coeff(A, B):
+def corr2_coeff(A, B, dtype=None):
+    if isinstance(A, CorrelationOperand):
+        return A.correlate(B)
+    if isinstance(B, CorrelationOperand):
+        return B.correlate(A).T
+    dtype = get_compute_dtype(dtype)
+    A = np.asarray(A, dtype=dtype)
+    B = np.asarray(B, dtype=dtype)
     # Rowwise mean of input arrays & subtract from input arrays themeselves
-    A_mA = A - A.mean(1)[:, None]
-    B_mB = B - B.mean(1)[:, None]
+    A_mA = A - A.mean(1, dtype=np.float64).astype(dtype)[:, None]
+    B_mB = B - B.mean(1, dtype=np.float64).astype(dtype)[:, None]
 
     # Sum of squares across rows
-    ssA = (A_mA ** 2).sum(1)
-    ssB = (B_mB ** 2).sum(1)
+    ssA = np.square(A_mA).sum(1, dtype=np.float64)
+    ssB = np.square(B_mB).sum(1, dtype=np.float64)
 
     # Finally get corr coeff
-    return np.dot(A_mA, B_mB.T) / np.sqrt(np.dot(ssA[:, None], ssB[None]))
+    return (np.dot(A_mA, B_mB.T) / np.sqrt(np.dot(ssA[:, None], ssB[None]))).astype(dtype, copy=False)
 
 
-def seed_correlation(functional_image, atlas_image, mask_image):
+def _zscore_columns(signals):
+    # Same as nilearn's standardize=True: population std and no scaling of flat signals
+    mean = signals.mean(0, dtype=np.float64)
+    std = signals.std(0, dtype=np.float64)
+    std[std < np.finfo(np.float64).eps] = 1.
+    return ((signals - mean.astype(signals.dtype)) / std.astype(signals.dtype)).astype(signals.dtype, copy=False)
+
+
+def seed_masker(atlas_image, mask_image, reference_image=None):
+    """
+    Voxel and label indices of an atlas inside a brain mask
+
+    :param atlas_image: 3D nibabel image with integers for ROIs and 0 as background
+    :param mask_image: 3D nibabel image with 0 as background and 1 as brain.
+    :param reference_image: nibabel image whose grid atlas and mask are resampled to if they differ, like nilearn
+                            does for the data. None to use the grid of the mask
+    :return: dict with the voxel coordinates in the mask (in the same order as NiftiMasker), the label index of each
+             voxel (-1 for background), the label values, and the grid (shape, affine)
     """
+    if reference_image is not None and not (mask_image.shape[:3] == reference_image.shape[:3]
+                                            and np.allclose(mask_image.affine, reference_image.affine)):
+        mask_image = nimg.resample_to_img(mask_image, reference_image, interpolation='nearest')
+    if not (atlas_image.shape[:3] == mask_image.shape[:3] and np.allclose(atlas_image.affine, mask_image.affine)):
+        atlas_image = nimg.resample_to_img(atlas_image, mask_image, interpolation='nearest')
+    mask = np.asarray(mask_image.dataobj) != 0
+    atlas = np.asarray(atlas_image.dataobj)
+    labels = np.unique(atlas)
+    labels = labels[labels != 0]
+    voxel_label = np.searchsorted(labels, atlas[mask])
+    voxel_label[atlas[mask] == 0] = -1
+    masker = {'voxels': np.nonzero(mask),
+              'voxel_label': voxel_label,
+              'labels': labels,
+              'shape': mask.shape,
+              'affine': mask_image.affine}
+    return masker
+
+
+def seed_correlation(functional_image, atlas_image, mask_image, dtype=None, chunk_size=10000, masker=None):
+    """
+    Seed based correlation between the mean time series of each atlas region and every voxel in the mask.
+
+    The 4D data is read once. Voxels are then processed in blocks of chunk_size: a first sweep collects the region
+    means, a second one z-scores each block and writes its correlations into the preallocated output. The full
+    (n_timepoints, n_voxels) matrix is never built, so peak memory is the image plus the output plus one block.
 
     :param functional_image: 4D nibabel image with time in the 4th dimension
     :param atlas_image: 3D nibabel image with integers for ROIs and 0 as background
     :param mask_image: 3D nibabel image with 0 as background and 1 as brain.
+    :param dtype: floating point type of the time series and correlations. Defaults to COMPUTE_DTYPE
+    :param chunk_size: number of voxels processed at a time
+    :param masker: precomputed output of seed_masker to reuse across subjects. atlas_image and mask_image are
+                   ignored if it is given
     :return: fisher z transformed correlations. shape = (n_voxels, n_regions)
     """
-    atlas_masker = nid.NiftiLabelsMasker(labels_img=atlas_image, mask_img=mask_image, standardize=True)
-    brain_masker = nid.NiftiMasker(mask_image, verbose=0, standardize=True)
-    seed_time_series = atlas_masker.fit_transform(functional_image)
-    brain_time_series = brain_masker.fit_transform(functional_image)
+    dtype = get_compute_dtype(dtype)
+    if masker is None:
+        masker = seed_masker(atlas_image, mask_image, functional_image)
+    elif not (functional_image.shape[:3] == masker['shape'] and np.allclose(functional_image.affine,
+                                                                          masker['affine'])):
+        raise Exception(f'The functional image and the masker are on different grids: '
+                        f'image ({functional_image.shape[:3]}), masker ({masker["shape"]})')
+    # Read the stored values without scaling them to float64. Correlations don't change under the affine scaling
+    # of the image, so it is applied per block to stay faithful to the stored data
+    proxy = functional_image.dataobj
+    if hasattr(proxy, 'get_unscaled'):
+        data = proxy.get_unscaled()
+        slope, inter = proxy.slope, proxy.inter
+    else:
+        data = np.asarray(proxy)
+        slope, inter = 1., 0.
+    x, y, z = masker['voxels']
+    n_voxels = len(x)
+    n_regions = len(masker['labels'])
+    n_timepoints = data.shape[3]
 
-    seed_correlations = np.dot(brain_time_series.T, seed_time_series) / seed_time_series.shape[0]
-    seed_correlations_fisher_z = np.arctanh(seed_correlations)
+    def read_block(start):
+        block = data[x[start:start + chunk_size], y[start:start + chunk_size], z[start:start + chunk_size], :]
+        return (block.T.astype(dtype) * dtype.type(slope) + dtype.type(inter)).astype(dtype, copy=False)
+
+    # Region means
+    region_sums = np.zeros((n_timepoints, n_regions))
+    for start in range(0, n_voxels, chunk_size):
+        block_label = masker['voxel_label'][start:start + chunk_size]
+        in_region = block_label >= 0
+        one_hot = np.zeros((len(block_label), n_regions))
+        one_hot[np.nonzero(in_region)[0], block_label[in_region]] = 1
+        region_sums += read_block(start) @ one_hot
+    region_size = np.bincount(masker['voxel_label'][masker['voxel_label'] >= 0], minlength=n_regions)
+    seed_time_series = _zscore_columns((region_sums / np.maximum(region_size, 1)).astype(dtype))
+
+    # Correlations block by block
+    seed_correlations_fisher_z = np.empty((n_voxels, n_regions), dtype=dtype)
+    for start in range(0, n_voxels, chunk_size):
+        brain_block = _zscore_columns(read_block(start))
+        block_corr = seed_correlations_fisher_z[start:start + chunk_size]
+        np.dot(brain_block.T, seed_time_series, out=block_corr)
+        block_corr /= n_timepoints
+        np.arctanh(block_corr, out=block_corr)
 
-    # seed_based_correlation_img = brain_masker.inverse_transform(seed_correlations_fisher_z.T)
     return seed_correlations_fisher_z
 
 
-def nuisance_correction(data_stack, design_matrix, n_jobs=1):
+def residual_basis(design_matrix):
     """
-    :param data_stack: 2D or 3D array of (n_subjects, n_voxels, n_seeds)
-    :param design_matrix: patsy or numpy style design matrix (n_subjects, n_factors)
-    :param n_jobs:
-    :return: residuals as 2D or 3D array of same dimensions as input array
+    Orthonormal basis of the column space of one or many design matrices
+
+    :param design_matrix: 2D array (n_subjects, n_factors) or 3D array (n_designs, n_subjects, n_factors).
+                          The columns must be linearly independent
+    :return: array of the same shape as design_matrix with orthonormal columns
     """
-    model = sln.LinearRegression(fit_intercept=False, normalize=False, n_jobs=n_jobs)
-    if data_stack.ndim == 3:
-        n_seeds = data_stack.shape[2]
-        residuals = np.stack([nuisance_correction(data_stack[..., seed_id], design_matrix, n_jobs)
-                              for seed_id in range(n_seeds)], -1)
-    else:
-        results = model.fit(design_matrix, data_stack)
-        residuals = data_stack - results.predict(design_matrix)
+    basis, _ = np.linalg.qr(np.asarray(design_matrix, dtype=float))
+    return basis
+
+
+def nuisance_correction(data_stack, design_matrix, n_jobs=1, dtype=None):
+    """
+    Regress the design out of every voxel and seed at once. The projection on the design is computed once with a
+    QR decomposition and applied to the whole stack as a (n_subjects, n_voxels * n_seeds) matrix.
+
+    :param data_stack: 2D or 3D array of (n_subjects, n_voxels, n_seeds). When design_matrix is a list of designs, an
+                       array with an additional leading dimension (n_designs, n_subjects, ...) or a list of arrays
+    :param design_matrix: patsy or numpy style design matrix (n_subjects, n_factors), or a list of design matrices
+                          with the same shape, for example one per bootstrap sample
+    :param n_jobs: kept for backwards compatibility. Threading is left to BLAS
+    :param dtype: floating point type of the residuals. Defaults to COMPUTE_DTYPE
+    :return: residuals as 2D or 3D array of same dimensions as input array, with the leading n_designs dimension if
+             a list of designs was given
+    """
+    dtype = get_compute_dtype(dtype)
+    batched = type(design_matrix) == list
+    design = np.asarray(np.stack(design_matrix) if batched else design_matrix, dtype=float)
+    data = np.asarray(np.stack(data_stack) if type(data_stack) == list else data_stack, dtype=dtype)
+    if not data.shape[:design.ndim - 1] == design.shape[:-1]:
+        raise Exception(f'data and design must have the same number of subjects (and designs): '
+                        f'data({data.shape}), design({design.shape})')
+    basis = residual_basis(design).astype(dtype)
+    # Flatten voxels and seeds so that the projection is a single matrix product per design
+    flat = data.reshape(data.shape[:design.ndim - 1] + (-1,))
+    residuals = flat - basis @ (np.swapaxes(basis, -1, -2) @ flat)
+    return residuals.reshape(data.shape)
+
+
+class IncrementalResidualizer:
+    """
+    Nuisance regression of a fixed training set that is augmented by one test subject at a time.
+
+    The training design is factorized once. Adding a subject with design row x and data y changes the fit by a
+    rank-one (Sherman-Morrison) update: with the training leverage h = x' (X'X)^-1 x and the prediction error
+    e = y - x' beta, the residual of the new subject is e / (1 + h) and the training residuals move by
+    X (X'X)^-1 x e' / (1 + h). This gives exactly the residuals of a full refit on the augmented set.
+    """
+
+    def __init__(self, data_stack, design_matrix, dtype=None):
+        """
+        :param data_stack: 2D or 3D array of the training data (n_subjects, n_voxels, n_seeds)
+        :param design_matrix: patsy or numpy style design matrix of the training data (n_subjects, n_factors)
+        :param dtype: floating point type of the residuals. Defaults to COMPUTE_DTYPE
+        """
+        self.dtype = get_compute_dtype(dtype)
+        self.design = np.asarray(design_matrix, dtype=float)
+        self.data_shape = data_stack.shape[1:]
+        flat = np.asarray(data_stack, dtype=self.dtype).reshape(data_stack.shape[0], -1)
+        basis, upper = np.linalg.qr(self.design)
+        upper_inv = sp.linalg.solve_triangular(upper, np.eye(upper.shape[0]))
+        # (X'X)^-1 from the triangular factor
+        self.gram_inv = upper_inv @ upper_inv.T
+        self.coef = (upper_inv @ (basis.T.astype(self.dtype) @ flat)).astype(self.dtype, copy=False)
+        self.residuals = flat - self.design.astype(self.dtype) @ self.coef
+
+    def _update(self, data_row, design_row):
+        design_row = np.atleast_2d(np.asarray(design_row, dtype=float))
+        data_row = np.asarray(data_row, dtype=self.dtype).reshape(design_row.shape[0], -1)
+        gram_x = design_row @ self.gram_inv
+        leverage = np.sum(gram_x * design_row, 1)
+        error = (data_row - design_row.astype(self.dtype) @ self.coef) / (1 + leverage)[:, None].astype(self.dtype)
+        return gram_x, error
+
+    def test_residuals(self, data_row, design_row):
+        """
+        Residuals of test subjects, each appended on its own to the training set
+
+        :param data_row: 1D/2D array of one subject (n_voxels, n_seeds) or 2D/3D array of many (n_test, ...)
+        :param design_row: 1D design row (n_factors) or 2D array of many (n_test, n_factors)
+        :return: residuals with the same shape as data_row
+        """
+        _, error = self._update(data_row, design_row)
+        return error.reshape(np.shape(data_row))
+
+    def augmented_residuals(self, data_row, design_row):
+        """
+        Residuals of the training set plus one test subject, the test subject being the last row
+
+        :param data_row: array of one subject (n_voxels, n_seeds)
+        :param design_row: 1D design row (n_factors)
+        :return: residuals of shape (n_subjects + 1, n_voxels, n_seeds)
+        """
+        gram_x, error = self._update(data_row, design_row)
+        train_residuals = self.residuals - (self.design @ gram_x.T).astype(self.dtype) @ error
+        return np.concatenate([train_residuals, error]).reshape((-1,) + self.data_shape)
+
+
+
+def ward_d_cut(dist, n_subtypes):
+    """
+    Reproduce hclust(dist, method='ward.D') followed by cutree(k=n_subtypes) in R
+
+    :param dist: 1D condensed euclidean distances, in the order of scipy's pdist
+    :param n_subtypes: int
+    :return: 1D array of subtype labels from 1 to n_subtypes, numbered by first appearance like cutree
+    """
+    # scipy's ward squares the distances in the Lance-Williams update (ward.D2). Feeding it the square root
+    # of the distances makes the update linear in the original distances, which is what ward.D does
+    link = scl.hierarchy.linkage(np.sqrt(dist), method='ward')
+    part = scl.hierarchy.fcluster(link, n_subtypes, criterion='maxclust')
+    _, first_seen, inverse = np.unique(part, return_index=True, return_inverse=True)
+    rank = np.empty(len(first_seen), dtype=int)
+    rank[np.argsort(first_seen)] = np.arange(1, len(first_seen) + 1)
+    return rank[inverse]
+
+
+class LeaveOneInClustering:
+    """
+    Ward.D subtypes of the scaled nuisance residual maps of a fixed training set that is augmented by one test subject
+    at a time, as in the leave-one-in conformal scores.
+
+    Appending a test subject moves every training residual map by a multiple of the test residual map e (see
+    IncrementalResidualizer): r_i -> r_i - u_i e. After centering each map, the dot products of the augmented maps
+    are G - u g' - g u' + |e|^2 u u' between training maps and g - |e|^2 u with the test map, where G are the dot
+    products of the centered training maps, computed once, and g those with the centered test map. The distances of
+    the scaled maps and the subtype weights only depend on the resulting correlations, so a test subject costs one
+    matrix vector product with the training maps instead of a distance matrix over all voxels.
+
+    The test subject enters the nuisance fit, so all training distances move with it and the ward tree of the
+    training set alone never carries over exactly. The tree is rebuilt from the updated distances instead, which
+    is cheap next to the distances themselves. Subjects drawn several times by a bootstrap are only computed once
+    and then copied, so their rows of distances and weights are bit-identical. A test subject that is also in the
+    training set gets the rows of its training copies in the same way, as it does in R.
+    """
+
+    def __init__(self, data_stack, design_matrix, train_index=None, dtype=None):
+        """
+        :param data_stack: 2D array (n_subjects, n_voxels)
+        :param design_matrix: 2D array (n_subjects, n_factors) of nuisance design, including the intercept
+        :param train_index: 1D array of 0-based rows of the training set, with repeats for a bootstrap sample.
+                            None uses all rows once
+        :param dtype: floating point type of the residual maps. Defaults to COMPUTE_DTYPE. The dot products and
+                      correlations are always float64
+        """
+        self.dtype = get_compute_dtype(dtype)
+        design_matrix = np.asarray(design_matrix, dtype=float)
+        train_index = np.arange(data_stack.shape[0]) if train_index is None else np.asarray(train_index)
+        self.unique_subjects, first, self.inverse = np.unique(train_index, return_index=True, return_inverse=True)
+        residualizer = IncrementalResidualizer(data_stack[train_index], design_matrix[train_index], dtype=self.dtype)
+        self.n_voxels = data_stack.shape[1]
+        self.residualizer = residualizer
+        self.unique_design = residualizer.design[first]
+        self.centered = residualizer.residuals[first]
+        self.centered -= self.centered.mean(1, dtype=np.float64).astype(self.dtype)[:, None]
+        # Only test residuals are needed from here on, so don't keep a second copy of the training maps
+        residualizer.residuals = None
+        self.gram = np.dot(self.centered, self.centered.T).astype(np.float64)
+
+    def correlation(self, data_row, design_row):
+        """
+        :param data_row: 1D array (n_voxels) of the test subject
+        :param design_row: 1D design row (n_factors) of the test subject
+        :return: 2D array (n_unique + 1, n_unique + 1) of correlations between the residual maps of the unique
+                 training subjects and of the test subject, last. See augmented_index to expand them
+        """
+        error = self.residualizer.test_residuals(data_row, design_row).astype(np.float64)
+        error -= error.mean()
+        shift = self.unique_design @ (self.residualizer.gram_inv @ np.asarray(design_row, dtype=float))
+        cross = np.dot(self.centered, error.astype(self.dtype)).astype(np.float64)
+        error_ss = error @ error
+        n_unique = len(shift)
+        half_cross = cross - 0.5 * error_ss * shift
+        gram = np.empty((n_unique + 1, n_unique + 1))
+        gram[:n_unique, :n_unique] = self.gram - np.outer(shift, half_cross) - np.outer(half_cross, shift)
+        gram[n_unique, :n_unique] = gram[:n_unique, n_unique] = cross - error_ss * shift
+        gram[n_unique, n_unique] = error_ss
+        norm = np.sqrt(np.diag(gram))
+        return gram / norm[:, None] / norm[None, :]
+
+    def augmented_index(self, subject=None):
+        """
+        :param subject: 0-based row of the test subject in data_stack, if it can also be in the training set
+        :return: 1D array (n_train + 1) of the rows of correlation that belong to the training set and to the test
+                 subject, last
+        """
+        test_row = len(self.unique_subjects)
+        if subject is not None:
+            copy = np.searchsorted(self.unique_subjects, subject)
+            if copy < test_row and self.unique_subjects[copy] == subject:
+                test_row = copy
+        return np.append(self.inverse, test_row)
+
+    def distance(self, corr, index):
+        """
+        :param corr: 2D array of correlations, see correlation
+        :param index: 1D array of rows of corr, see augmented_index
+        :return: 1D condensed euclidean distances between the residual maps of the training set and the test subject
+                 scaled to unit standard deviation (ddof=1), same as pdist of the scaled maps
+        """
+        dist = np.sqrt(np.maximum(2 * (self.n_voxels - 1) * (1 - corr), 0))
+        np.fill_diagonal(dist, 0)
+        return ssd.squareform(dist[np.ix_(index, index)], checks=False)
+
+    def subtype_weights(self, corr, index, partition, n_subtypes):
+        """
+        :param corr: 2D array of correlations, see correlation
+        :param index: 1D array of rows of corr, see augmented_index
+        :param partition: 1D array of subtype labels from 1 to n_subtypes of the training set and the test subject
+        :param n_subtypes: int
+        :return: 2D array (n_train + 1, n_subtypes) of correlations between each scaled residual map and the mean
+                 scaled map of each subtype
+        """
+        one_hot = (partition[:, None] == np.arange(1, n_subtypes + 1)[None, :]).astype(float)
+        # The dot product of a scaled map with a subtype mean is proportional to its summed correlations with the
+        # maps of the subtype, and the squared norm of the mean to the summed correlations within the subtype
+        subtype_corr = (corr[:, index] @ one_hot)[index]
+        return subtype_corr / np.sqrt(np.sum(one_hot * subtype_corr, 0))[None, :]
+
+    def subtypes(self, data_row, design_row, n_subtypes=5, subject=None):
+        """
+        :param data_row: 1D array (n_voxels) of the test subject
+        :param design_row: 1D design row (n_factors) of the test subject
+        :param n_subtypes: int. Number of subtypes cut from the ward tree
+        :param subject: 0-based row of the test subject in data_stack, see augmented_index
+        :return: tuple of the partition (n_train + 1), see ward_d_cut, and the subtype weights (n_train + 1,
+                 n_subtypes), see subtype_weights. The test subject is last
+        """
+        corr = self.correlation(data_row, design_row)
+        index = self.augmented_index(subject)
+        partition = ward_d_cut(self.distance(corr, index), n_subtypes)
+        return partition, self.subtype_weights(corr, index, partition, n_subtypes)
+
+class SessionMeanCache:
+    """
+    Means over subsets of the sessions (last axis) of one data stack, e.g. the subtype sessions of a stability
+    analysis. Subset sums are built by adding one session at a time to the longest cached prefix of the subset, so
+    the selected sessions are never gathered into a copy and subsets that share a prefix share the work. The sums are
+    kept in a least recently used store with a memory budget.
+    """
+
+    def __init__(self, data_stack, max_bytes=2 * 1024 ** 3):
+        """
+        :param data_stack: array (or read-only memmap) with the sessions along the last axis
+        :param max_bytes: memory budget of the cached subset sums
+        """
+        self.data_stack = data_stack
+        # Same result type as np.mean
+        self.dtype = data_stack.dtype if np.issubdtype(data_stack.dtype, np.floating) else np.dtype(np.float64)
+        self.max_bytes = max_bytes
+        self.sums = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.sums)
+
+    @property
+    def nbytes(self):
+        return sum([session_sum.nbytes for session_sum in self.sums.values()])
+
+    def _store(self, session_ids, session_sum):
+        self.sums[session_ids] = session_sum
+        while self.nbytes > self.max_bytes and len(self.sums) > 1:
+            self.sums.popitem(last=False)
+
+    def session_sum(self, session_ids):
+        """
+        :param session_ids: sorted tuple of session indices
+        :return: sum over the sessions. Cached arrays are shared, do not change them
+        """
+        start = 0
+        total = None
+        # Single sessions are only a view of the data and are not cached
+        for n_prefix in range(len(session_ids), 1, -1):
+            if session_ids[:n_prefix] in self.sums:
+                self.sums.move_to_end(session_ids[:n_prefix])
+                start, total = n_prefix, self.sums[session_ids[:n_prefix]]
+                break
+        for n_prefix in range(start + 1, len(session_ids) + 1):
+            session = self.data_stack[..., session_ids[n_prefix - 1]]
+            if total is None:
+                total = np.array(session, dtype=self.dtype)
+            else:
+                # A new array, the cached prefix sum stays as it is
+                total = total + session
+                self._store(session_ids[:n_prefix], total)
+        return total
+
+    def mean(self, session_ids):
+        """
+        :param session_ids: iterable of session indices
+        :return: new array with the mean over the sessions, like np.mean(data_stack[..., session_ids], -1)
+        """
+        session_ids = tuple(sorted(session_ids))
+        if not session_ids:
+            raise Exception('Cannot average an empty set of sessions')
+        return self.session_sum(session_ids) / len(session_ids)
+
+    def invalidate(self):
+        """
+        Drop all cached sums, e.g. after the data stack was changed
+        """
+        self.sums.clear()
+
+
+def _seed_major_blocks(data_stack, dtype=None, block_size=128):
+    # Yield (voxel slice, contiguous (n_seeds, n_subjects, block) copy) pairs. Transposing the seeds to the front
+    # one small block at a time stays in cache, where a single moveaxis copy of the whole stack does not
+    dtype = data_stack.dtype if dtype is None else dtype
+    for start in range(0, data_stack.shape[1], block_size):
+        block = slice(start, start + block_size)
+        seed_major = np.empty((data_stack.shape[2], data_stack.shape[0], min(block_size, data_stack.shape[1] - start)),
+                              dtype=dtype)
+        np.copyto(seed_major, np.moveaxis(data_stack[:, block, :], 2, 0), casting='unsafe')
+        yield block, seed_major
+
+
+class CorrelationOperand:
+    """
+    Rows of a matrix centered and scaled to unit norm once, so that correlating them with other rows is a single
+    matrix product. Useful when the same subjects are correlated with many sets of subtypes.
+
+    2D data (n_rows, n_columns) correlates row by row. 3D data stacks (n_subjects, n_voxels, n_seeds) are stored
+    seed-major and correlate seed by seed. The operand has the shape and ndim of the original data, so it can be
+    passed to corr2_coeff and subtype_weights in place of the data.
+    """
+
+    def __init__(self, data, dtype=None):
+        """
+        :param data: 2D or 3D array
+        :param dtype: floating point type of the normalized rows. Defaults to COMPUTE_DTYPE
+        """
+        self.dtype = get_compute_dtype(dtype)
+        data = np.asarray(data)
+        if data.ndim not in (2, 3):
+            raise Exception(f'Data must be 2D or 3D but has shape {data.shape} ({data.ndim} D)')
+        self.shape = data.shape
+        self.ndim = data.ndim
+        if data.ndim == 2:
+            self.normalized = _normalize_rows(np.array(data, dtype=self.dtype))
+        else:
+            # Center and sum the squares while the seeds are moved to the front block by block
+            mean = np.moveaxis(data.mean(1, dtype=np.float64), 1, 0)[..., None].astype(self.dtype)
+            sum_sq = np.zeros((data.shape[2], data.shape[0]), dtype=np.float64)
+            self.normalized = np.empty((data.shape[2], data.shape[0], data.shape[1]), dtype=self.dtype)
+            for block, values in _seed_major_blocks(data, dtype=self.dtype):
+                values -= mean
+                sum_sq += np.einsum('siv,siv->si', values, values, dtype=np.float64)
+                self.normalized[..., block] = values
+            with np.errstate(invalid='ignore', divide='ignore'):
+                np.divide(self.normalized, np.sqrt(sum_sq)[..., None], out=self.normalized, casting='unsafe')
+
+    @classmethod
+    def from_normalized(cls, normalized):
+        """
+        :param normalized: rows that are already centered and scaled to unit norm, 2D or seed-major 3D
+        :return: CorrelationOperand wrapping them without a copy
+        """
+        operand = cls.__new__(cls)
+        operand.dtype = normalized.dtype
+        operand.normalized = normalized
+        operand.ndim = normalized.ndim
+        operand.shape = normalized.shape if normalized.ndim == 2 else (normalized.shape[1], normalized.shape[2],
+                                                                       normalized.shape[0])
+        return operand
+
+    @property
+    def nbytes(self):
+        return 0 if self.normalized is None else self.normalized.nbytes
+
+    def invalidate(self):
+        """
+        Release the normalized rows. The operand cannot be used afterwards
+        """
+        self.normalized = None
+
+    def correlate(self, other):
+        """
+        :param other: CorrelationOperand or array with the same number of columns (and seeds) as this operand.
+                      3D operands take other arrays seed-major: (n_seeds, n_other, n_voxels)
+        :return: (n_rows, n_other) correlations for 2D and (n_seeds, n_subjects, n_other) for 3D operands
+        """
+        if self.normalized is None:
+            raise Exception('This correlation operand was invalidated')
+        if isinstance(other, CorrelationOperand):
+            if not other.ndim == self.ndim:
+                raise Exception(f'Cannot correlate a {self.ndim}D with a {other.ndim}D operand')
+            other = other.normalized
+        else:
+            other = _normalize_rows(np.array(other, dtype=self.dtype))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.normalized @ np.swapaxes(other, -1, -2)
+
 
-    return residuals
+def _normalize_rows(data):
+    # Center and scale the last axis to unit norm in place. Sums of squares are accumulated in float64 and flat rows
+    # become NaN like in corr2_coeff
+    data -= data.mean(-1, dtype=np.float64)[..., None].astype(data.dtype)
+    norm = np.sqrt(np.einsum('...v,...v->...', data, data, dtype=np.float64))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        np.divide(data, norm[..., None], out=data, casting='unsafe')
+    return data
+
+
+class CorrelationCache:
+    """
+    Least recently used store of CorrelationOperands with a memory budget, e.g. one operand per session of a stability
+    analysis. Operands are built on the first request of their key and the least recently used ones are evicted once
+    the budget is exceeded. The cache does not notice if the data behind a key changes, call invalidate in that case.
+    """
+
+    def __init__(self, max_bytes=2 * 1024 ** 3, dtype=None):
+        """
+        :param max_bytes: memory budget of all cached operands. The last requested operand is always kept
+        :param dtype: floating point type of the operands. Defaults to COMPUTE_DTYPE
+        """
+        self.max_bytes = max_bytes
+        self.dtype = dtype
+        self.operands = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.operands)
+
+    def __contains__(self, key):
+        return key in self.operands
+
+    @property
+    def nbytes(self):
+        return sum([operand.nbytes for operand in self.operands.values()])
+
+    def get(self, key, data):
+        """
+        :param key: hashable key of the data, e.g. the session index
+        :param data: array used to build the operand if the key is not cached. A callable returning the array is
+                     only evaluated on a cache miss
+        :return: CorrelationOperand
+        """
+        if key in self.operands and self.operands[key].dtype == get_compute_dtype(self.dtype):
+            self.operands.move_to_end(key)
+            return self.operands[key]
+        self.invalidate(key)
+        operand = CorrelationOperand(data() if callable(data) else data, dtype=self.dtype)
+        self.operands[key] = operand
+        while self.nbytes > self.max_bytes and len(self.operands) > 1:
+            _, evicted = self.operands.popitem(last=False)
+            evicted.invalidate()
+        return operand
+
+    def invalidate(self, key=None):
+        """
+        :param key: key to drop from the cache. None drops all keys
+        :return:
+        """
+        keys = list(self.operands.keys()) if key is None else [key]
+        for k in keys:
+            if k in self.operands:
+                self.operands.pop(k).invalidate()
 
 
 def subtype_maps(data_stack, part, method=np.mean):
@@ -102,42 +712,217 @@ def subtype_maps(data_stack, part, method=np.mean):
     :param data_stack: (n_subject, n_voxel, n_seed (optional)). 2D or 3D array of the data
     :param part: (n_subject, n_seed (optional) 1D or 2D array of subtype partitions. Zero values are ignored to allow
                  for thresholded subtypes
-    :param method: A function reference to compute the subtype map. Default is numpy.mean
+    :param method: A function reference to compute the subtype map. Default is numpy.mean, which is computed for
+                   all seeds and subtypes at once
     :return: numpy array for 2D input and list of numpy arrays for 3D input
     """
     if data_stack.ndim == 3 or part.ndim == 2:
         if not (data_stack.ndim == 3 and part.ndim == 2) or not data_stack.shape[-1] == part.shape[-1]:
             raise Exception(f'data and part must have the same last dimension when run across seeds: '
                             f'data({data_stack.shape}), part({part.shape})')
-        n_iter = part.shape[-1]
-        sbt_maps = [subtype_maps(data_stack[..., i], part[..., i]) for i in range(n_iter)]
+        if not method is np.mean:
+            n_iter = part.shape[-1]
+            return [subtype_maps(data_stack[..., i], part[..., i], method) for i in range(n_iter)]
+        # Subtypes are numbered from 1 to the number of non zero parts in each seed
+        sorted_part = np.sort(part, axis=0)
+        n_subtypes = np.sum(np.diff(sorted_part, axis=0) != 0, axis=0) + (sorted_part[0] != 0)
+        # One-hot membership of shape (n_seeds, max_subtypes, n_subjects)
+        one_hot = (part.T[:, None, :] == np.arange(1, np.max(n_subtypes, initial=0) + 1)[None, :, None])
+        sizes = one_hot.sum(2, keepdims=True)
+        one_hot = one_hot.astype(data_stack.dtype)
+        # Sum the members of all subtypes in one batched product over seeds
+        centroids = np.empty((part.shape[1], one_hot.shape[1], data_stack.shape[1]), dtype=data_stack.dtype)
+        for block, seed_major in _seed_major_blocks(data_stack):
+            np.matmul(one_hot, seed_major, out=centroids[:, :, block])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            centroids /= sizes
+        # Seeds without subtypes get the (0,) shaped array of np.array([]) like the per seed implementation
+        sbt_maps = [centroids[i, :n_subtypes[i]] if n_subtypes[i] > 0 else np.array([]) for i in range(part.shape[1])]
+    elif method is np.mean:
+        sbt_maps = subtype_maps(data_stack[..., None], part[:, None])[0]
     else:
         n_subtypes = np.sum(np.unique(part) != 0)
         sbt_maps = np.array([method(data_stack[part == sbt_id, :], 0) for sbt_id in range(1, n_subtypes + 1)])
     return sbt_maps
 
 
-def constrain_partition(partition, min_cases=2):
+def constrain_partition(partition, min_cases=2, return_sizes=False):
     """
 
     :param partition: 1D partition vector where each unique number corresponds to a part
     :param min_cases: the minimum number of occurrences for a part to be kept in the constrained partition
-    :return:
+    :param return_sizes: if True, also return the number of cases in each part of the constrained partition
+    :return: constrained partition, and if return_sizes the 1D array of part sizes ordered by their label (parts
+             labelled 0 are not counted)
     """
-    masked_partition = np.array([0 if sum(partition == p) < min_cases else p for p in partition])
+    labels, inverse, counts = np.unique(partition, return_inverse=True, return_counts=True)
+    masked_labels = np.where(counts < min_cases, 0, labels)
     # The remaining elements will always be sorted so 0 can remain 0
-    remaining_elements = list(np.unique(masked_partition))
+    remaining_elements = np.unique(masked_labels)
     if 0 in remaining_elements:
         # Reassign values to the remaining partitions
-        constrained_partition = np.array([remaining_elements.index(p) for p in masked_partition])
+        constrained_labels = np.searchsorted(remaining_elements, masked_labels)
     else:
         # Nothing to do, all elements of the partition are more frequent than required
-        constrained_partition = masked_partition
+        constrained_labels = masked_labels
+    constrained_partition = constrained_labels[inverse.reshape(-1)]
 
+    if return_sizes:
+        # Add up the counts of the original parts that were merged into the same constrained part
+        part_labels, part_ids = np.unique(constrained_labels, return_inverse=True)
+        sizes = np.bincount(part_ids.reshape(-1), weights=counts, minlength=len(part_labels)).astype(int)
+        return constrained_partition, sizes[part_labels != 0]
     return constrained_partition
 
 
-def subtype_partition(data_stack, mode='classic', n_subtypes=3, dist_thr=0.7, part_thr=20):
+def _scale_rows(data, dtype):
+    # Normalize to 0 mean and unit variance across columns per row
+    if dtype == np.float64:
+        return skp.scale(np.asarray(data, dtype=dtype), axis=1)
+    # sklearn warns about float32 rounding, so accumulate the moments in float64 ourselves
+    data = np.asarray(data, dtype=dtype)
+    mean = data.mean(1, dtype=np.float64)
+    std = data.std(1, dtype=np.float64)
+    std[std == 0] = 1
+    return ((data - mean.astype(dtype)[:, None]) / std.astype(dtype)[:, None]).astype(dtype, copy=False)
+
+
+def correlation_distance(data, dtype=None, block_size=1024):
+    """
+    Condensed correlation distance (1 - r) between the rows of a matrix, in the order of scipy's pdist. Same as
+    taking the upper triangle of 1 - np.corrcoef(data) but without any n x n intermediate: the rows are normalized
+    once and correlated one block of rows at a time straight into the condensed vector.
+
+    :param data: 2D array (n_rows, n_columns)
+    :param dtype: floating point type of the normalized rows and of the products. The distances are float64
+    :param block_size: number of rows correlated at once. Memory use is block_size x n_rows
+    :return: 1D array of length n_rows * (n_rows - 1) / 2
+    """
+    norm = _normalize_rows(np.array(data, dtype=get_compute_dtype(dtype)))
+    n_rows = norm.shape[0]
+    dist = np.empty(n_rows * (n_rows - 1) // 2, dtype=np.float64)
+    for start in range(0, n_rows, block_size):
+        stop = min(start + block_size, n_rows)
+        # Only the columns right of the diagonal are needed
+        sim = norm[start:stop] @ norm[start:].T
+        np.clip(sim, -1, 1, out=sim)
+        for row in range(start, stop):
+            offset = row * n_rows - row * (row + 1) // 2
+            np.subtract(1, sim[row - start, row - start + 1:], out=dist[offset:offset + n_rows - row - 1])
+    return dist
+
+
+class SubtypeTree:
+    """
+    Hierarchical clustering of the subjects of one 2D data matrix (n_subjects, n_connections). The distances and the
+    linkage are computed once, partitions for any number of subtypes or thresholds are then cheap cuts of the tree.
+    The leaf order of the dendrogram is only computed when it is asked for.
+
+    Optimal leaf ordering of the linkage is superlinear in the number of subjects and only matters for display. With
+    ordered=False it is skipped until the order is requested. The partitions are then the same up to the labels of
+    the subtypes, and the order is the same as for ordered trees.
+    """
+
+    def __init__(self, data, mode='classic', dtype=None, ordered=True):
+        """
+        :param data: 2D array (n_subjects, n_connections)
+        :param mode: str. Either 'classic' for ward clustering of euclidean distances between normalized subjects or
+                     'core' and 'relative' for average clustering of correlation distances
+        :param dtype: floating point type of the normalized data and correlations. Distances are computed in float64
+        :param ordered: if True, order the linkage optimally before cutting it, as the partitions have always been.
+                        If False, cut the plain linkage and only order it for the order attribute
+        """
+        dtype = get_compute_dtype(dtype)
+        self.mode = mode
+        self.ordered = ordered
+        self.n_subjects = data.shape[0]
+        if mode == 'classic':
+            # Normalize to 0 mean and unit variance across voxels per subject
+            norm = _scale_rows(data, dtype)
+            # Get the lower triangle of the distance metric
+            self.dist = sp.spatial.distance.pdist(norm)
+            # Build the cluster
+            self.link = scl.hierarchy.linkage(self.dist, method='ward', optimal_ordering=ordered)
+        elif mode in ('core', 'relative'):
+            self.dist = correlation_distance(data, dtype)
+            self.link = scl.hierarchy.linkage(self.dist, method='average', optimal_ordering=ordered)
+        else:
+            raise Exception(f'{mode} is not implemented as mode to generate subtypes. Please use "classic" or "core".')
+        # The tree is shared by everyone who asks for the same data, so keep it from being changed
+        self.dist.flags.writeable = False
+        self.link.flags.writeable = False
+        self._order = None
+
+    @property
+    def order(self):
+        # Leaves of the optimally ordered dendrogram from left to right
+        if self._order is None:
+            link = self.link if self.ordered else scl.hierarchy.optimal_leaf_ordering(self.link, self.dist)
+            self._order = scl.hierarchy.dendrogram(link, no_plot=True)['leaves']
+        return self._order
+
+    def cut(self, n_subtypes=3, dist_thr=0.7, part_thr=20):
+        """
+        :param n_subtypes: int. Number of subtypes in 'classic' mode
+        :param dist_thr: float. Thresholds clusters by cophenetic distance ('core') or by the percentile of the
+                         distances ('relative')
+        :param part_thr: int. Only keep parts that have at least this many occurrences ('core') or this fraction of
+                         the subjects ('relative')
+        :return: 1D partition of the subjects
+        """
+        if self.mode == 'classic':
+            return scl.hierarchy.fcluster(self.link, n_subtypes, criterion='maxclust')
+        if self.mode == 'core':
+            dist_thr_emp = dist_thr
+            part_thr_emp = part_thr
+        else:
+            part_thr_emp = np.ceil(self.n_subjects * part_thr).astype(int)
+            dist_thr_emp = np.percentile(self.dist, dist_thr)
+        full_partition = scl.hierarchy.fcluster(self.link, dist_thr_emp, criterion='distance')
+        part = constrain_partition(full_partition, min_cases=part_thr_emp)
+        if np.max(part) == 0:
+            warnings.warn(f'Cannot find any subtypes that satisfy the criteria! Partition is empty.\n'
+                          f'    Subtyping {self.n_subjects} cases in {self.mode} mode with a distance cutoff of '
+                          f'{dist_thr_emp} and a minimum number of cases per subtype of {part_thr_emp} ')
+        return part
+
+
+def subtype_tree(data, mode='classic', dtype=None, use_cache=True, ordered=True):
+    """
+    Get the SubtypeTree of a 2D data matrix. Trees are cached by a hash of the data content, the mode and the dtype,
+    so the same data is only clustered once. The cache keeps the TREE_CACHE_SIZE most recently used trees.
+
+    :param data: 2D array (n_subjects, n_connections)
+    :param mode: str. 'classic', 'core' or 'relative', see SubtypeTree
+    :param dtype: floating point type of the normalized data and correlations. Defaults to COMPUTE_DTYPE
+    :param use_cache: if False, always build a new tree and do not cache it
+    :param ordered: see SubtypeTree. Ordered and unordered trees are cached separately
+    :return: SubtypeTree
+    """
+    dtype = get_compute_dtype(dtype)
+    if not use_cache:
+        return SubtypeTree(data, mode, dtype, ordered)
+    data = np.ascontiguousarray(data)
+    key = (hashlib.sha1(data.view(np.uint8)).hexdigest(), data.shape, data.dtype.str, mode, dtype.str, ordered)
+    if key in _tree_cache:
+        _tree_cache.move_to_end(key)
+        return _tree_cache[key]
+    tree = SubtypeTree(data, mode, dtype, ordered)
+    _tree_cache[key] = tree
+    while len(_tree_cache) > TREE_CACHE_SIZE:
+        _tree_cache.popitem(last=False)
+    return tree
+
+
+def clear_subtype_tree_cache():
+    """
+    Drop all cached subtype trees
+    """
+    _tree_cache.clear()
+
+
+def subtype_partition(data_stack, mode='classic', n_subtypes=3, dist_thr=0.7, part_thr=20, dtype=None,
+                      use_cache=True, ordered=True):
     """
 
     :param data_stack: 2D or 3D array (n_subjects, n_connections, n_seeds) (last optional)
@@ -146,67 +931,61 @@ def subtype_partition(data_stack, mode='classic', n_subtypes=3, dist_thr=0.7, pa
                       thresholds interpreted as rank percentages.
     :param dist_thr: float. Thresholds clusters by cophenetic distance
     :param part_thr: int. Only keep parts that have at least this many occurrences.
+    :param dtype: floating point type of the normalized data and correlations. Distances are computed in float64
+    :param use_cache: reuse the clustering of data that was partitioned before (see subtype_tree). The returned
+                      distances are then shared with the cache and read-only
+    :param ordered: if False, skip the optimal leaf ordering and the dendrogram and return None as order. Much faster
+                    for batch runs that throw the order away. Partitions are the same up to the subtype labels.
+                    Use subtype_order to get the display order later
     :return:
     """
+    dtype = get_compute_dtype(dtype)
     if data_stack.ndim == 3:
         # Process recursively and stack the results along the last (new) dimension
         n_iter = data_stack.shape[2]
-        part, dist, order = list(map(lambda x: np.stack(x, -1),
-                                     zip(*[subtype_partition(data_stack[..., i], mode, n_subtypes, dist_thr, part_thr)
-                                           for i in range(n_iter)])))
+        part, dist, order = zip(*[subtype_partition(data_stack[..., i], mode, n_subtypes, dist_thr, part_thr, dtype,
+                                                    use_cache, ordered)
+                                  for i in range(n_iter)])
+        part, dist = np.stack(part, -1), np.stack(dist, -1)
+        order = np.stack(order, -1) if ordered else None
     else:
-        if mode == 'classic':
-            # Normalize to 0 mean and unit variance across voxels per subject
-            norm = skp.scale(data_stack, axis=1)
-            # Get the lower triangle of the distance metric
-            dist = sp.spatial.distance.pdist(norm)
-            # Build the cluster
-            link = scl.hierarchy.linkage(dist, method='ward', optimal_ordering=True)
-            order = scl.hierarchy.dendrogram(link, no_plot=True)['leaves']
-            part = scl.hierarchy.fcluster(link, n_subtypes, criterion='maxclust')
-        elif mode == 'core':
-            sim = np.corrcoef(data_stack)
-            dist = 1 - sim[np.triu(np.ones(shape=sim.shape), 1).astype(bool)]
-            link = scl.hierarchy.linkage(dist, method='average', optimal_ordering=True)
-            order = scl.hierarchy.dendrogram(link, no_plot=True)['leaves']
-            full_partition = scl.hierarchy.fcluster(link, dist_thr, criterion='distance')
-            part = constrain_partition(full_partition, min_cases=part_thr)
-            if np.max(part) == 0:
-                warnings.warn(f'Cannot find any subtypes that satisfy the criteria! Partition is empty.\n'
-                              f'    Subtyping {data_stack.shape[0]} cases in {mode} mode with a distance cutoff of '
-                              f'{dist_thr} and a minimum number of cases per subtype of {part_thr} ')
-        elif mode == 'relative':
-            sim = np.corrcoef(data_stack)
-            n_subject = sim.shape[0]
-            part_thr_emp = np.ceil(n_subject * part_thr).astype(int)
-            dist = 1 - sim[np.triu(np.ones(shape=sim.shape), 1).astype(bool)]
-            dist_thr_emp = np.percentile(dist, dist_thr)
-            link = scl.hierarchy.linkage(dist, method='average', optimal_ordering=True)
-            order = scl.hierarchy.dendrogram(link, no_plot=True)['leaves']
-            full_partition = scl.hierarchy.fcluster(link, dist_thr_emp, criterion='distance')
-            part = constrain_partition(full_partition, min_cases=part_thr_emp)
-            if np.max(part) == 0:
-                warnings.warn(f'Cannot find any subtypes that satisfy the criteria! Partition is empty.\n'
-                              f'    Subtyping {data_stack.shape[0]} cases in {mode} mode with a distance cutoff of '
-                              f'{dist_thr_emp } and a minimum number of cases per subtype of {part_thr_emp} ')
-        else:
-            raise Exception(f'{mode} is not implemented as mode to generate subtypes. Please use "classic" or "core".')
+        tree = subtype_tree(data_stack, mode, dtype, use_cache, ordered)
+        part = tree.cut(n_subtypes, dist_thr, part_thr)
+        dist = tree.dist
+        order = tree.order if ordered else None
 
     return part, dist, order
 
 
-def subtype_weights(data_stack, subtypes):
+def subtype_order(data_stack, mode='classic', dtype=None, use_cache=True):
+    """
+    Display order of the subjects for plotting, the same order that subtype_partition returns with ordered=True
+
+    :param data_stack: 2D or 3D array (n_subjects, n_connections, n_seeds) (last optional)
+    :param mode: str. 'classic', 'core' or 'relative', see subtype_partition
+    :param dtype: floating point type of the normalized data and correlations
+    :param use_cache: reuse the clustering of data that was partitioned before (see subtype_tree)
+    :return: list of subject indices for 2D and (n_subjects, n_seeds) array for 3D data
+    """
+    if data_stack.ndim == 3:
+        return np.stack([subtype_order(data_stack[..., i], mode, dtype, use_cache)
+                         for i in range(data_stack.shape[2])], -1)
+    return subtype_tree(data_stack, mode, dtype, use_cache, ordered=False).order
+
+
+def subtype_weights(data_stack, subtypes, dtype=None):
     """
 
     :param subtypes: 2D array of shape (n_subtype, n_voxel) or a list of 2D arrays, one for each seed region
-    :param data_stack: 2D or 3D array of shape (n_subjects, n_voxel, n_seeds) - last optional
+    :param data_stack: 2D or 3D array of shape (n_subjects, n_voxel, n_seeds) - last optional. Can also be a
+                       CorrelationOperand of the data, which is reused instead of normalizing the data again
+    :param dtype: floating point type of the weights. Defaults to COMPUTE_DTYPE. Ignored for CorrelationOperands,
+                  which keep their own dtype
     :return: weight matrix as 2D or 3D array with shape (n_subjects, n_subtypes, n_seeds) - last optional
     """
     if not type(subtypes) == list:
         if subtypes.size == 0:
-            warnings.warn(f'I encountered an empty subtype map. This can happen if the corresponding partition that '
-                          f'generated this subtypes was thresholded until there were no individuals in a subtype '
-                          f'left. I will not crash here but I will return all NaN weights. Goodbye.')
+            _warn_empty_subtypes()
             # I will create all-zero weights if the subtype map is an empty array (indicating that this is a seed
             # without any satisfactory subtypes
             weights = np.empty(shape=(data_stack.shape[0], 1))
@@ -218,16 +997,108 @@ def subtype_weights(data_stack, subtypes):
                             f'data ({data_stack.ndim}; {type(data_stack)})')
 
         else:
-            weights = corr2_coeff(data_stack, subtypes)
+            weights = corr2_coeff(data_stack, subtypes, dtype)
     else:
         if not len(subtypes) == data_stack.shape[2]:
             raise Exception(f'Data is 3D but the number of seed regions is mismatched between subtypes and data: '
                             f'subtype ({len(subtypes)}) and data ({data_stack.shape[2]})')
-        n_seeds = len(subtypes)
-        weights = [subtype_weights(data_stack[..., seed_id], subtypes[seed_id]) for seed_id in range(n_seeds)]
+        weights = _batched_subtype_weights(data_stack, subtypes, dtype)
     return weights
 
 
+def _warn_empty_subtypes():
+    warnings.warn(f'I encountered an empty subtype map. This can happen if the corresponding partition that '
+                  f'generated this subtypes was thresholded until there were no individuals in a subtype '
+                  f'left. I will not crash here but I will return all NaN weights. Goodbye.')
+
+
+def _batched_subtype_weights(data_stack, subtypes, dtype=None):
+    # Correlate every subject with every subtype of every seed at once. The subtypes are padded into a
+    # (n_seeds, max_subtypes, n_voxels) tensor and the padding is cut off again afterwards
+    dtype = get_compute_dtype(dtype)
+    n_seeds = len(subtypes)
+    n_subtypes = np.array([sbt.shape[0] if sbt.size > 0 else 0 for sbt in subtypes])
+    for sbt in subtypes:
+        if sbt.size > 0 and not sbt.ndim == 2:
+            raise Exception(f'subtypes and data must have the same dimensions: '
+                            f'subtypes ({sbt.ndim}; {type(sbt)}) data (2; {type(data_stack)})')
+    n_subjects, n_voxels = data_stack.shape[:2]
+    if isinstance(data_stack, CorrelationOperand):
+        dtype = data_stack.dtype
+    padded = np.zeros((n_seeds, np.max(n_subtypes, initial=0), n_voxels), dtype=dtype)
+    for seed_id in np.flatnonzero(n_subtypes):
+        padded[seed_id, :n_subtypes[seed_id]] = subtypes[seed_id]
+    # Padding rows are flat and correlate as NaN, they are cut off below
+    padded = _normalize_rows(padded)
+    if isinstance(data_stack, CorrelationOperand):
+        corr = data_stack.correlate(CorrelationOperand.from_normalized(padded))
+    else:
+        # A one-off correlation does not need the normalized copy of the data. Center the data over voxels and
+        # accumulate the sums of squares and cross products one voxel block at a time, in float64
+        data_stack = np.asarray(data_stack)
+        data_mean = np.moveaxis(data_stack.mean(1, dtype=np.float64), 1, 0)[..., None].astype(dtype)
+        ss_data = np.zeros((n_seeds, n_subjects), dtype=np.float64)
+        cross = np.zeros((n_seeds, n_subjects, padded.shape[1]), dtype=np.float64)
+        for block, seed_major in _seed_major_blocks(data_stack, dtype=dtype):
+            seed_major -= data_mean
+            ss_data += np.einsum('siv,siv->si', seed_major, seed_major, dtype=np.float64)
+            cross += seed_major @ np.swapaxes(padded[:, :, block], 1, 2)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            corr = (cross / np.sqrt(ss_data)[:, :, None]).astype(dtype, copy=False)
+
+    weights = list()
+    for seed_id in range(n_seeds):
+        if n_subtypes[seed_id] == 0:
+            _warn_empty_subtypes()
+            empty = np.empty(shape=(n_subjects, 1))
+            empty[:] = np.nan
+            weights.append(empty)
+        else:
+            weights.append(corr[seed_id, :, :n_subtypes[seed_id]])
+    return weights
+
+
+def _co_membership_mismatch(part_a, part_b):
+    # Fraction of subject pairs that share a subtype in one partition but not in the other. Invariant to the
+    # labels of the subtypes. Subjects outside all subtypes (0) are never counted as sharing one
+    same_a = (part_a[:, None] == part_a[None, :]) & (part_a[:, None] != 0)
+    same_b = (part_b[:, None] == part_b[None, :]) & (part_b[:, None] != 0)
+    n_subjects = len(part_a)
+    return np.sum(np.triu(same_a != same_b, 1)) / (n_subjects * (n_subjects - 1) / 2)
+
+
+def compare_compute_dtype(data_stack, dtype=np.float32, n_sample=None, random_state=0, **partition_kwargs):
+    """
+    Check how much a lower precision compute dtype changes subtypes and weights compared to float64
+
+    :param data_stack: 2D or 3D array (n_subjects, n_voxels, n_seeds) - last optional
+    :param dtype: the compute dtype to check
+    :param n_sample: number of subjects drawn at random for the check. None uses all subjects
+    :param random_state: seed used to draw the sample
+    :param partition_kwargs: passed on to subtype_partition (mode, n_subtypes, dist_thr, part_thr)
+    :return: dict with the largest deviation across seeds of the partitions (fraction of mismatched subject pairs),
+             of the distances and of the weights. Weights are computed on the float64 partition in both cases
+    """
+    if n_sample is not None:
+        rng = np.random.default_rng(random_state)
+        data_stack = data_stack[np.sort(rng.choice(data_stack.shape[0], n_sample, replace=False))]
+    if data_stack.ndim == 2:
+        data_stack = data_stack[..., None]
+    data_stack = np.asarray(data_stack, dtype=np.float64)
+    ref_part, ref_dist, _ = subtype_partition(data_stack, dtype=np.float64, ordered=False, **partition_kwargs)
+    part, dist, _ = subtype_partition(data_stack, dtype=dtype, ordered=False, **partition_kwargs)
+    low_stack = data_stack.astype(dtype)
+    ref_weights = subtype_weights(data_stack, subtype_maps(data_stack, ref_part), dtype=np.float64)
+    weights = subtype_weights(low_stack, subtype_maps(low_stack, ref_part), dtype=dtype)
+    n_seeds = data_stack.shape[2]
+    deviation = {'partition_mismatch': max([_co_membership_mismatch(ref_part[:, i], part[:, i])
+                                            for i in range(n_seeds)]),
+                 'distance_max_abs': np.max(np.abs(ref_dist - dist)),
+                 'weight_max_abs': np.nanmax([np.nanmax(np.abs(ref_weights[i] - weights[i]), initial=0)
+                                              for i in range(n_seeds)])}
+    return deviation
+
+
 def compute_icc(ratings, cse, kind):
     """
     Computes the interclass correlations for indexing the reliability analysis
@@ -236,7 +1107,8 @@ def compute_icc(ratings, cse, kind):
     ratings - ratings data matrix, data whose rows represent different
         ratings/raters & whose columns represent different cases or
         targets being measured. Each target is assumed too be a random
-        sample from a population of targets.
+        sample from a population of targets. Can also be a (..., k, n)
+        stack of ratings matrices, which are all computed at once.
     cse - 1 2 or 3: 1 if each target is measured by a different set of
         raters from a population of raters, 2 if each target is measured
         by the same raters, but that these raters are sampled from a
@@ -264,23 +1136,23 @@ def compute_icc(ratings, cse, kind):
     """
 
     # k is the number of raters, and n is the number of targets
-    k, n = ratings.shape
+    k, n = ratings.shape[-2:]
     # mean per target
-    mpt = np.mean(ratings, 0)
+    mpt = np.mean(ratings, -2)
     # mean per rater
-    mpr = np.mean(ratings, 1)
+    mpr = np.mean(ratings, -1)
     # get total mean
-    tm = np.mean(ratings)
+    tm = np.mean(ratings, (-2, -1))
     # within target sum sqares
-    wss = np.sum(np.square(ratings - mpt))
+    wss = np.sum(np.square(ratings - mpt[..., None, :]), (-2, -1))
     # within target mean sqares
     wms = wss / (n * (k - 1))
     # between rater sum squares
-    rss = np.sum(np.square(mpr - tm)) * n
+    rss = np.sum(np.square(mpr - tm[..., None]), -1) * n
     # between rater mean squares
     rms = rss / (k - 1)
     # between target sum squares
-    bss = np.sum(np.square(mpt - tm)) * k
+    bss = np.sum(np.square(mpt - tm[..., None]), -1) * k
     # between target mean squares
     bms = bss / (n - 1)
     # residual sum of squares
@@ -312,3 +1184,28 @@ def compute_icc(ratings, cse, kind):
     else:
         raise Exception('Wrong value for "cse": {cse}')
     return icc, wms, bms
+
+
+def compute_icc_bootstrap(ratings, cse, kind, n_boot=1000, ci=95, random_state=0):
+    """
+    Bootstrap confidence interval of compute_icc. The targets are resampled with replacement and all resamples are
+    evaluated in one batched compute_icc call, so memory grows with n_boot times the size of the ratings.
+
+    :param ratings: (..., k, n) ratings with raters in the second to last and targets in the last axis
+    :param cse: see compute_icc
+    :param kind: see compute_icc
+    :param n_boot: number of bootstrap resamples of the targets
+    :param ci: width of the confidence interval in percent
+    :param random_state: seed of the resampling
+    :return: icc, lower and upper bound of the confidence interval, each of shape ratings.shape[:-2]
+    """
+    ratings = np.asarray(ratings)
+    n = ratings.shape[-1]
+    rng = np.random.default_rng(random_state)
+    boot_idx = rng.integers(0, n, size=(n_boot, n))
+    # (..., k, n_boot, n) -> (n_boot, ..., k, n)
+    boot_ratings = np.moveaxis(ratings[..., boot_idx], -2, 0)
+    boot_icc, _, _ = compute_icc(boot_ratings, cse, kind)
+    icc, _, _ = compute_icc(ratings, cse, kind)
+    lower, upper = np.percentile(boot_icc, [(100 - ci) / 2, 100 - (100 - ci) / 2], axis=0)
+    return icc, lower, upper
@@ -3,16 +3,26 @@ import time
 import itertools as it
 
 
-def find_all_combinations(n_elements, n_group=2):
+def iter_all_combinations(n_elements, n_group=2):
+    """
+    Lazily generate the same (icc sessions, subtype sessions) pairs as find_all_combinations, one at a time. The
+    number of pairs grows exponentially with the number of sessions, so prefer this over the list for many sessions.
+
+    :param n_elements: number of sessions
+    :param n_group: number of sessions to compute ICC on
+    :return: generator of (icc_sessions, subtype_sessions) tuples
+    """
     # Define the session IDs
     elements = list(range(n_elements))
-    # Find all combinations of 2 sessions to compute ICC on
-    icc_sessions = list(it.combinations(elements, n_group))
-    # Find the remaining sessions for each of the ICC sessions
-    remaining_sessions = [list(set(elements) - set(icc_s)) for icc_s in icc_sessions]
-    # Find all combinations of subtype sessions for 1 - 8 subtype sessions
-    session_pairs = [(icc, sbt) for rem, icc in zip(remaining_sessions, icc_sessions)
-                     for n_sbt in range(1, len(rem) + 1)
-                     for sbt in list(it.combinations(rem, n_sbt))]
+    # Go through all combinations of 2 sessions to compute ICC on
+    for icc in it.combinations(elements, n_group):
+        # Find the remaining sessions for the ICC sessions
+        rem = list(set(elements) - set(icc))
+        # Go through all combinations of subtype sessions for 1 - 8 subtype sessions
+        for n_sbt in range(1, len(rem) + 1):
+            for sbt in it.combinations(rem, n_sbt):
+                yield icc, sbt
 
-    return session_pairs
+
+def find_all_combinations(n_elements, n_group=2):
+    return list(iter_all_combinations(n_elements, n_group))
@@ -0,0 +1,130 @@
+import os
+import numpy as np
+import pandas as pd
+import pathlib as pal
+import multiprocessing as mp
+from .stats import LeaveOneInClustering
+from .data import ensure_seed_store, open_seed_store
+from .logistic import conformal_p_values
+from .conformal import N_NETWORKS, leave_one_in_designs, write_results_csv
+
+
+def validation_scores(working_map, regressed_vars, classes_var, working_map_val, regressed_vars_val, n_subtypes=5,
+                      dtype=None, warm_start=False):
+    """
+    Conformal scores of Validation_Conformal_Score.R for one network: every validation subject is appended on its
+    own to all training subjects
+
+    :param working_map: 2D array (n_train, n_voxels) of training seed maps
+    :param regressed_vars: 2D array (n_train, n_factors) of training nuisance design, including the intercept
+    :param classes_var: 1D array of 0/1 training labels (1 = autism)
+    :param working_map_val: 2D array (n_val, n_voxels) of validation seed maps
+    :param regressed_vars_val: 2D array (n_val, n_factors) of validation nuisance design
+    :param n_subtypes: int. Number of subtypes cut from the ward tree
+    :param dtype: floating point type of the residual maps, see asdfc.stats.LeaveOneInClustering
+    :param warm_start: see asdfc.logistic.conformal_p_values
+    :return: tuple of 1D arrays (p_values, p0_values)
+    """
+    # Everything that only depends on the training set is computed once per network
+    clustering = LeaveOneInClustering(working_map, regressed_vars, dtype=dtype)
+    designs = leave_one_in_designs(clustering, working_map_val, regressed_vars_val, n_subtypes)
+    return conformal_p_values(designs, classes_var, warm_start=warm_start)
+
+
+def _nuisance_design(pheno):
+    return np.column_stack([np.ones(len(pheno)), pheno['AGE_AT_SCAN'].values,
+                            pheno['fd_scrubbed'].values]).astype(float)
+
+
+def load_validation_data(source_dir, debug=False):
+    """
+    Load the discovery (ABIDE 1) and validation (ABIDE 2) seed maps and phenotypes once
+
+    :param source_dir: path to the folder with the seed maps and the phenotype tables
+    :param debug: if True, only keep the first 20 subjects of each phenotype table
+    :return: dict with the network-major seed stores (seed_store, seed_store_val), the nuisance designs
+             (regressed_vars, regressed_vars_val) and the training labels (classes_var)
+    """
+    source_dir = pal.Path(source_dir)
+    data = dict()
+    for suffix, map_name, pheno_name in [('', 'seed_maps_no_cereb.npy', 'ABIDE1_Pheno_PSM_matched.tsv'),
+                                         ('_val', 'abide_2_seed_maps_no_cereb.npy', 'ABIDE2_Pheno_PSM_matched.tsv')]:
+        pheno = pd.read_csv(source_dir / pheno_name, sep='\t')
+        if debug:
+            pheno = pheno.iloc[:20]
+        data[f'seed_store{suffix}'] = open_seed_store(ensure_seed_store(source_dir / map_name))
+        data[f'regressed_vars{suffix}'] = _nuisance_design(pheno)
+        if suffix == '':
+            data['classes_var'] = np.where(pheno['DX_GROUP'].values == 'Control', 0, 1)
+    return data
+
+
+def validation_result_path(output_dir, network):
+    return pal.Path(output_dir) / f'Results_Real_Network_{network}.csv'
+
+
+def run_validation_network(data, network, output_dir):
+    """
+    Python equivalent of one network of Validation_Conformal_Score.R
+
+    :param data: dict, see load_validation_data
+    :param network: int. 1-based network number, as in the file name
+    :param output_dir: path to the output folder
+    :return: pathlib path to the results file
+    """
+    n_train = data['regressed_vars'].shape[0]
+    n_val = data['regressed_vars_val'].shape[0]
+    working_map = np.asarray(data['seed_store'][network - 1][:n_train], dtype=float)
+    working_map_val = np.asarray(data['seed_store_val'][network - 1][:n_val], dtype=float)
+    p_values, p0_values = validation_scores(working_map, data['regressed_vars'], data['classes_var'],
+                                            working_map_val, data['regressed_vars_val'])
+    # cbind in R recycles the shorter columns up to the longest one, which np.resize does too
+    n_rows = max(n_train, n_val)
+    out_p = validation_result_path(output_dir, network)
+    write_results_csv(out_p, np.resize(np.arange(1, n_train + 1), n_rows), np.resize(np.arange(1, n_val + 1), n_rows),
+                      np.resize(p_values, n_rows), np.resize(p0_values, n_rows))
+    return out_p
+
+
+# State of a validation worker process, loaded once in _init_validation_worker
+_validation_worker = dict()
+
+
+def _init_validation_worker(source_dir, output_dir, debug):
+    from threadpoolctl import threadpool_limits
+    # Limit internal threading to 1 to avoid nested parallelism
+    threadpool_limits(1)
+    _validation_worker['data'] = load_validation_data(source_dir, debug)
+    _validation_worker['output_dir'] = output_dir
+
+
+def _run_validation_job(network):
+    return network, str(run_validation_network(_validation_worker['data'], network, _validation_worker['output_dir']))
+
+
+def run_validation_jobs(source_dir, output_dir, networks=None, debug=False, n_procs=1):
+    """
+    Run the validation of many networks in worker processes, one network per job. Networks with a results file
+    are skipped
+
+    :param source_dir: path to the source data folder
+    :param output_dir: path to the output folder
+    :param networks: iterable of 1-based networks. Defaults to all N_NETWORKS
+    :param debug: if True, only use the first 20 subjects of each phenotype table
+    :param n_procs: number of worker processes
+    :return: list of (network, output path) for the networks that were run
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    networks = range(1, N_NETWORKS + 1) if networks is None else networks
+    networks = [network for network in networks if not validation_result_path(output_dir, network).is_file()]
+    if not networks:
+        return []
+    source_dir = pal.Path(source_dir)
+    # Build the stores before the workers start so they don't race to write them
+    for map_name in ['seed_maps_no_cereb.npy', 'abide_2_seed_maps_no_cereb.npy']:
+        ensure_seed_store(source_dir / map_name)
+    if n_procs == 1:
+        _init_validation_worker(source_dir, output_dir, debug)
+        return [_run_validation_job(network) for network in networks]
+    with mp.Pool(n_procs, initializer=_init_validation_worker, initargs=(source_dir, output_dir, debug)) as pool:
+        return list(pool.imap_unordered(_run_validation_job, networks))
@@ -1,10 +1,15 @@
+import os
 import functools
+import collections
 import numpy as np
+import pandas as pd
 import nibabel as nib
 import pathlib as pal
-from .stats import seed_correlation, \
-    subtype_partition, subtype_maps, subtype_weights, \
-    compute_icc
+import multiprocessing as mp
+from .stats import seed_correlation, seed_masker, get_compute_dtype, \
+    subtype_partition, subtype_maps, subtype_weights, constrain_partition, \
+    compute_icc, CorrelationCache, SessionMeanCache
+from .tools import iter_all_combinations
 
 
 def unpacker(func):
@@ -15,7 +20,8 @@ def unpacker(func):
     return wrapper_unpacker
 
 
-def wrap_seed_based_correlation(func_in_p, sca_out_p, atlas_img, mask_img, confound_img=None, clobber=False):
+def wrap_seed_based_correlation(func_in_p, sca_out_p, atlas_img, mask_img, confound_img=None, clobber=False,
+                                masker=None):
     """
 
     :param func_in_p: path to scrubbed functional time series
@@ -25,6 +31,7 @@ def wrap_seed_based_correlation(func_in_p, sca_out_p, atlas_img, mask_img, confo
     :param confound_img: nibabel image of confounds to be regressed. Uses partial seed correlation.
                          None if none are to be regressed
     :param clobber: if True, overwrite. Otherwise stop if output exists
+    :param masker: precomputed stats.seed_masker of atlas_img and mask_img to reuse across subjects
     :return:
     """
     if not issubclass(type(sca_out_p), pal.Path):
@@ -32,14 +39,91 @@ def wrap_seed_based_correlation(func_in_p, sca_out_p, atlas_img, mask_img, confo
     if sca_out_p.is_file() and not clobber:
         raise Exception(f'Designated output file exists. Set clobber=True to overwrite:\n{sca_out_p}')
     func_i = nib.load(str(func_in_p))
-    seed_map_fisher_z = seed_correlation(func_i, atlas_img, mask_img)
+    seed_map_fisher_z = seed_correlation(func_i, atlas_img, mask_img, masker=masker)
     np.save(str(sca_out_p), seed_map_fisher_z)
     return sca_out_p.is_file()
 
 
-def wrap_weight_stability(data_stack, sbt_ids, icc_ids, mode='classic', n_subtypes=3, dist_thr=0.7, part_thr=20):
+# Masker and output stack of a seed correlation worker process, set once in _init_seed_correlation_worker
+_seed_worker = dict()
+
+
+def _init_seed_correlation_worker(atlas_img, mask_img, masker, stack_p):
+    _seed_worker['atlas_img'] = atlas_img
+    _seed_worker['mask_img'] = mask_img
+    _seed_worker['masker'] = masker
+    _seed_worker['stack'] = np.load(str(stack_p), mmap_mode='r+')
+
+
+@unpacker
+def _seed_correlation_job(subject_id, func_in_p, sca_out_p, clobber):
+    stack = _seed_worker['stack']
+    if sca_out_p is not None and pal.Path(sca_out_p).is_file() and not clobber:
+        # Reuse the existing seed map of this subject
+        stack[subject_id] = np.load(str(sca_out_p))
+    elif sca_out_p is not None:
+        wrap_seed_based_correlation(func_in_p, sca_out_p, _seed_worker['atlas_img'], _seed_worker['mask_img'],
+                                    clobber=clobber, masker=_seed_worker['masker'])
+        stack[subject_id] = np.load(str(sca_out_p))
+    else:
+        stack[subject_id] = seed_correlation(nib.load(str(func_in_p)), None, None, masker=_seed_worker['masker'])
+    stack.flush()
+    return subject_id
+
+
+def wrap_seed_based_correlation_batch(path_pairs, stack_out_p, atlas_img, mask_img, n_procs=1, clobber=False,
+                                      clobber_maps=False, dtype=None):
+    """
+    Seed maps of many subjects written into one (n_subjects, n_voxels, n_regions) seed stack, e.g. to build
+    seed_maps_no_cereb.npy for a new cohort. The atlas and mask are resolved once and shared by all workers.
+
+    :param path_pairs: list of (func_in_p, sca_out_p) tuples in the order of the subjects in the stack.
+                       sca_out_p can be None to only write into the stack. Existing sca_out_p files are reused
+                       unless clobber_maps is True, so a rerun after a failed build only computes the missing maps
+    :param stack_out_p: pathlib path to the .npy seed stack
+    :param atlas_img: nibabel image of atlas partition
+    :param mask_img: nibabel image of atlas mask. All functional images must be on the grid of the mask
+    :param n_procs: number of worker processes
+    :param clobber: if True, overwrite an existing seed stack
+    :param clobber_maps: if True, recompute and overwrite existing per subject seed maps
+    :param dtype: numpy dtype of the seed stack. Defaults to stats.COMPUTE_DTYPE
+    :return: True if the seed stack exists
+    """
+    if not issubclass(type(stack_out_p), pal.Path):
+        stack_out_p = pal.Path(stack_out_p)
+    if stack_out_p.is_file() and not clobber:
+        raise Exception(f'Designated output file exists. Set clobber=True to overwrite:\n{stack_out_p}')
+    masker = seed_masker(atlas_img, mask_img)
+    shape = (len(path_pairs), len(masker['voxel_label']), len(masker['labels']))
+    # Fill the stack under a temporary name and only move it in place once every subject is in, so a failed build
+    # never leaves a stack with empty subjects behind
+    tmp_p = stack_out_p.with_name(f'.{stack_out_p.name}.{os.getpid()}.tmp')
+    stack = np.lib.format.open_memmap(str(tmp_p), mode='w+', dtype=get_compute_dtype(dtype), shape=shape)
+    del stack
+    jobs = [{'subject_id': subject_id, 'func_in_p': func_in_p, 'sca_out_p': sca_out_p, 'clobber': clobber_maps}
+            for subject_id, (func_in_p, sca_out_p) in enumerate(path_pairs)]
+    init_args = (atlas_img, mask_img, masker, tmp_p)
+    try:
+        if n_procs == 1:
+            _init_seed_correlation_worker(*init_args)
+            list(map(_seed_correlation_job, jobs))
+            _seed_worker.clear()
+        else:
+            with mp.Pool(n_procs, initializer=_init_seed_correlation_worker, initargs=init_args) as pool:
+                list(pool.imap_unordered(_seed_correlation_job, jobs))
+    except BaseException:
+        _seed_worker.clear()
+        tmp_p.unlink(missing_ok=True)
+        raise
+    os.replace(tmp_p, stack_out_p)
+    return stack_out_p.is_file()
+
+
+def wrap_weight_stability(data_stack, sbt_ids, icc_ids, mode='classic', n_subtypes=3, dist_thr=0.7, part_thr=20,
+                          operand_cache=None, mean_cache=None):
     """
-    type: (np.ndarray, tuple, tuple, str, int, float, int) -> np.ndarray
+    type: (np.ndarray, tuple, tuple, str, int, float, int, stats.CorrelationCache, stats.SessionMeanCache)
+          -> np.ndarray
 
     :param data_stack: numpy.ndarray of 4D
     :param sbt_ids: tuple with integer indices of the session to be used to generate subtypes
@@ -48,6 +132,10 @@ def wrap_weight_stability(data_stack, sbt_ids, icc_ids, mode='classic', n_subtyp
     :param n_subtypes: (only in 'classic' mode)
     :param dist_thr: (only in 'core' mode) float. maximum distance of subjects in a subtype
     :param part_thr: (only in 'core' mode) int, minimum number of subjects that need to be in a valid subtype
+    :param operand_cache: optional stats.CorrelationCache keyed by session index. Reuse the same cache across calls
+                          on the same data_stack so every session is normalized only once. None normalizes every time
+    :param mean_cache: optional stats.SessionMeanCache of data_stack that reuses the sums of session subsets across
+                       calls. None averages the selected sessions every time
     :return:
     """
     if not data_stack.ndim == 4:
@@ -56,14 +144,22 @@ def wrap_weight_stability(data_stack, sbt_ids, icc_ids, mode='classic', n_subtyp
     scale = data_stack.shape[2]
     n_icc = len(icc_ids)
     # Average the sessions used to make subtypes
-    sbt_stack = np.mean(data_stack[..., sbt_ids], -1)
+    if mean_cache is None:
+        sbt_stack = np.mean(data_stack[..., sbt_ids], -1)
+    else:
+        sbt_stack = mean_cache.mean(sbt_ids)
     # Slice the sessions used for the weights
     icc_stack = data_stack[..., icc_ids]
     # Transitioned this to thresholded subtype mode
+    # The display order is not needed here, so skip the optimal leaf ordering
     partition, distance, _ = subtype_partition(sbt_stack, mode=mode, n_subtypes=n_subtypes,
-                                               dist_thr=dist_thr, part_thr=part_thr)
+                                               dist_thr=dist_thr, part_thr=part_thr, ordered=False)
     subtypes = subtype_maps(sbt_stack, partition)
-    weight_list = [subtype_weights(icc_stack[..., w_id], subtypes) for w_id in range(n_icc)]
+    if operand_cache is None:
+        weight_list = [subtype_weights(icc_stack[..., w_id], subtypes) for w_id in range(n_icc)]
+    else:
+        weight_list = [subtype_weights(operand_cache.get(icc_ids[w_id], icc_stack[..., w_id]), subtypes)
+                       for w_id in range(n_icc)]
 
     # The weight list is ordered: [ sessions [ seeds (subjects, subtype) ] ] with the tuple being the weights
     # Because the number of subtypes can differ between seeds, we cannot store this as an array
@@ -74,9 +170,10 @@ def wrap_weight_stability(data_stack, sbt_ids, icc_ids, mode='classic', n_subtyp
     # which we average across subtypes to receive a 3-tuple of (icc, wms, bms). We iterate over seeds and stack those
     # tuples up which means that at the end we arrive at a (n_seeds, 3) array. This wouldn't really work without
     # averaging across subtypes.
-    results = np.array([np.mean(np.stack([compute_icc(np.stack([weight_list[ses][seed][:, sbt]
-                                                                for ses in range(n_icc)], -1).T, 1, 'single')
-                                          for sbt in range(weight_list[0][seed].shape[1])], axis=-1), axis=1)
+    # For each seed, the weights of all subtypes are stacked to (n_subtype, n_session, n_subject) ratings and their
+    # ICC is computed in one batched call
+    results = np.array([np.mean(compute_icc(np.stack([weight_list[ses][seed].T for ses in range(n_icc)], 1),
+                                            1, 'single'), axis=1)
                         for seed in range(scale)])
     n_sbt = list()
     avg_size_sbt = list()
@@ -84,22 +181,157 @@ def wrap_weight_stability(data_stack, sbt_ids, icc_ids, mode='classic', n_subtyp
     n_in_sbt = list()
     n_out_sbt = list()
     for seed_id in range(scale):
+        # Nothing is removed with min_cases=1, this only counts the subjects in each subtype
+        _, sbt_sizes = constrain_partition(partition[:, seed_id], min_cases=1, return_sizes=True)
         n_sbt.append(np.max(partition[:, seed_id]))
-        n_in_sbt.append(np.sum(partition[:, seed_id] != 0))
-        n_out_sbt.append(np.sum(partition[:, seed_id] == 0))
+        n_in_sbt.append(np.sum(sbt_sizes))
+        n_out_sbt.append(partition.shape[0] - np.sum(sbt_sizes))
         if np.max(partition[:, seed_id]) == 0:
             avg_size_sbt.append(0)
             min_size_sbt.append(0)
         else:
-            avgsz = np.mean([np.sum(partition[:, seed_id] == part_id)
-                             for part_id in np.unique(partition[:, seed_id]) if not part_id == 0])
-            minsz = np.min([np.sum(partition[:, seed_id] == part_id)
-                            for part_id in np.unique(partition[:, seed_id]) if not part_id == 0])
-            avg_size_sbt.append(avgsz)
-            min_size_sbt.append(minsz)
+            avg_size_sbt.append(np.mean(sbt_sizes))
+            min_size_sbt.append(np.min(sbt_sizes))
 
     sbt_info = np.stack([n_sbt, n_in_sbt, n_out_sbt, avg_size_sbt, min_size_sbt], -1)
     res_array = np.concatenate([results, sbt_info], 1)
     # The res_array has the dimensions (n_seeds, 8. With the following order
     # icc, wms, bms, n_sbt, n_subjects_in_subtypes, n_subjects_outside_subtypes, avg_subtype_size, min_subtype_size
     return res_array
+
+
+# Columns of the weight stability table. One row per combination, parameter setting and seed
+STABILITY_KEYS = ['icc_ids', 'sbt_ids', 'mode', 'n_subtypes', 'dist_thr', 'part_thr']
+STABILITY_COLUMNS = STABILITY_KEYS + ['seed', 'icc', 'wms', 'bms', 'n_sbt', 'n_subjects_in_subtypes',
+                                      'n_subjects_outside_subtypes', 'avg_subtype_size', 'min_subtype_size']
+
+# Data stack and correlation cache of a weight stability worker process, set once in _init_weight_stability_worker
+_stability_worker = dict()
+
+
+def _init_weight_stability_worker(data_stack_p, cache_bytes, limit_threads):
+    if limit_threads:
+        from threadpoolctl import threadpool_limits
+        # Limit internal threading to 1 to avoid nested parallelism
+        threadpool_limits(1)
+    _stability_worker['data_stack'] = np.load(str(data_stack_p), mmap_mode='r')
+    _stability_worker['operand_cache'] = CorrelationCache(max_bytes=cache_bytes)
+    _stability_worker['mean_cache'] = SessionMeanCache(_stability_worker['data_stack'], max_bytes=cache_bytes)
+
+
+@unpacker
+def _weight_stability_job(icc_ids, sbt_ids, mode, n_subtypes, dist_thr, part_thr):
+    res_array = wrap_weight_stability(_stability_worker['data_stack'], sbt_ids, icc_ids, mode=mode,
+                                      n_subtypes=n_subtypes, dist_thr=dist_thr, part_thr=part_thr,
+                                      operand_cache=_stability_worker['operand_cache'],
+                                      mean_cache=_stability_worker['mean_cache'])
+    return icc_ids, sbt_ids, res_array
+
+
+def _stability_key(icc_ids, sbt_ids, mode, n_subtypes, dist_thr, part_thr):
+    # The key columns as they are written to the table
+    return ('-'.join(map(str, icc_ids)), '-'.join(map(str, sbt_ids)), str(mode), str(n_subtypes), str(dist_thr),
+            str(part_thr))
+
+
+def _resume_stability_table(table_p, n_seeds):
+    # Find the combinations that are complete in the table. Each combination is appended in a single write, so only
+    # the last one can be incomplete after a crash. It is cut off so it can be appended again.
+    done = set()
+    if not table_p.is_file():
+        with open(table_p, 'w') as f:
+            f.write('\t'.join(STABILITY_COLUMNS) + '\n')
+        return done
+    with open(table_p, 'rb') as f:
+        lines = f.read().split(b'\n')
+    offset = len(lines[0]) + 1
+    group_key, group_start, group_rows = None, offset, 0
+    for line in lines[1:-1]:
+        fields = line.decode().split('\t')
+        key = tuple(fields[:len(STABILITY_KEYS)])
+        if not key == group_key:
+            group_key, group_start, group_rows = key, offset, 0
+        if len(fields) == len(STABILITY_COLUMNS):
+            group_rows += 1
+        if group_rows == n_seeds:
+            done.add(group_key)
+            group_start = offset + len(line) + 1
+        offset += len(line) + 1
+    if group_start < os.path.getsize(table_p):
+        os.truncate(table_p, group_start)
+    return done
+
+
+def _append_stability_rows(table_p, key, res_array):
+    rows = ['\t'.join(key + (str(seed_id),) + tuple(repr(float(val)) for val in res_array[seed_id]))
+            for seed_id in range(res_array.shape[0])]
+    with open(table_p, 'a') as f:
+        f.write('\n'.join(rows) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def wrap_weight_stability_batch(data_stack_p, table_p, n_icc=2, mode='classic', n_subtypes=3, dist_thr=0.7,
+                                part_thr=20, n_procs=1, cache_bytes=2 * 1024 ** 3, max_pending=None):
+    """
+    Run wrap_weight_stability for every combination of tools.iter_all_combinations and append the results to a
+    tab separated table. The combinations are generated lazily and only a few are in flight at any time. Every worker
+    memory maps the data stack read-only, so it is neither copied nor pickled per job. Combinations already in the
+    table are skipped, so an interrupted run continues where it stopped when it is called again.
+
+    :param data_stack_p: pathlib path to a .npy file of the 4D data stack (n_subjects, n_voxels, n_seeds, n_sessions)
+    :param table_p: pathlib path to the .tsv table. Rows are keyed by combination and subtype parameters
+    :param n_icc: number of sessions to compute ICC on
+    :param mode: see wrap_weight_stability
+    :param n_subtypes: see wrap_weight_stability
+    :param dist_thr: see wrap_weight_stability
+    :param part_thr: see wrap_weight_stability
+    :param n_procs: number of worker processes
+    :param cache_bytes: memory budget of the normalized sessions (stats.CorrelationCache) and, separately, of the
+                        session subset sums (stats.SessionMeanCache) that each worker caches
+    :param max_pending: maximum number of combinations in flight. Defaults to 4 per worker
+    :return: pandas DataFrame of the table
+    """
+    data_stack_p = pal.Path(data_stack_p)
+    table_p = pal.Path(table_p)
+    data_stack = np.load(str(data_stack_p), mmap_mode='r')
+    if not data_stack.ndim == 4:
+        raise Exception(f'Data Stack must be 4D array but has shape {data_stack.shape} ({data_stack.ndim} D)')
+    n_seeds, n_sessions = data_stack.shape[2:]
+    del data_stack
+    max_pending = 4 * n_procs if max_pending is None else max_pending
+    params = {'mode': mode, 'n_subtypes': n_subtypes, 'dist_thr': dist_thr, 'part_thr': part_thr}
+    done = _resume_stability_table(table_p, n_seeds)
+    jobs = ({'icc_ids': icc_ids, 'sbt_ids': sbt_ids, **params}
+            for icc_ids, sbt_ids in iter_all_combinations(n_sessions, n_icc)
+            if _stability_key(icc_ids, sbt_ids, **params) not in done)
+
+    def append(result):
+        icc_ids, sbt_ids, res_array = result
+        _append_stability_rows(table_p, _stability_key(icc_ids, sbt_ids, **params), res_array)
+
+    if n_procs == 1:
+        _init_weight_stability_worker(data_stack_p, cache_bytes, False)
+        for job in jobs:
+            append(_weight_stability_job(job))
+        _stability_worker.clear()
+    else:
+        with mp.Pool(n_procs, initializer=_init_weight_stability_worker,
+                     initargs=(data_stack_p, cache_bytes, True)) as pool:
+            # Submit a bounded number of jobs at a time instead of handing the whole generator to the pool
+            pending = collections.deque()
+            for job in jobs:
+                pending.append(pool.apply_async(_weight_stability_job, (job,)))
+                if len(pending) >= max_pending:
+                    append(pending.popleft().get())
+            while pending:
+                append(pending.popleft().get())
+    return read_weight_stability_table(table_p)
+
+
+def read_weight_stability_table(table_p):
+    """
+    :param table_p: pathlib path to a table written by wrap_weight_stability_batch
+    :return: pandas DataFrame with one row per combination, parameter setting and seed
+    """
+    return pd.read_csv(table_p, sep='\t', dtype={'icc_ids': str, 'sbt_ids': str, 'mode': str})
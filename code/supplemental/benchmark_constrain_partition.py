@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Benchmark of constrain_partition
+# constrain_partition used to count every part once per element, which is quadratic in the number of subjects. It
+# now counts the parts with np.unique. This script checks that both give the same partition for 10k subjects and
+# times them.
+#
+# On one core (10000 subjects, 200 parts, min_cases=60):
+# implementation  time_s
+#      reference  5.7366
+#     vectorized  0.0004
+
+import sys
+import time
+import numpy as np
+import pandas as pd
+import pathlib as pal
+
+sys.path.insert(0, str(pal.Path(__file__).resolve().parents[1] / "figures"))
+from asdfc import stats
+
+n_subjects = 10000
+n_parts = 200
+min_cases = 60
+rng = np.random.default_rng(0)
+
+
+def reference_constrain_partition(partition, min_cases=2):
+    # The previous, element by element implementation
+    masked_partition = np.array([0 if sum(partition == p) < min_cases else p for p in partition])
+    remaining_elements = list(np.unique(masked_partition))
+    if 0 in remaining_elements:
+        constrained_partition = np.array([remaining_elements.index(p) for p in masked_partition])
+    else:
+        constrained_partition = masked_partition
+    return constrained_partition
+
+
+partition = rng.integers(1, n_parts + 1, n_subjects)
+rows = list()
+results = dict()
+for name, func in [("reference", reference_constrain_partition), ("vectorized", stats.constrain_partition)]:
+    start = time.perf_counter()
+    results[name] = func(partition, min_cases=min_cases)
+    rows.append({"implementation": name, "time_s": time.perf_counter() - start})
+
+if not np.array_equal(results["reference"], results["vectorized"]):
+    raise Exception("The vectorized partition differs from the reference")
+print(pd.DataFrame(rows).to_string(index=False, float_format="{:.4f}".format))
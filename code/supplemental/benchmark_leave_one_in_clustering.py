@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Benchmark of the leave-one-in clustering
+# The conformal scores used to rebuild the residual maps, the distance matrix over all voxels, the ward tree and the
+# subtype weights of all n + 1 subjects for every test subject. stats.LeaveOneInClustering computes the dot products
+# of the training maps once and only adds the test subject, then rebuilds the ward tree from the updated distances.
+# This script checks that both give the same partitions and designs on a bootstrap sample and times them.
+#
+# On one core (400 subjects, 20000 voxels, 20 test subjects):
+# implementation  time_s
+#   full rebuild 10.7308
+#    incremental  0.1331
+
+import sys
+import time
+import numpy as np
+import pandas as pd
+import pathlib as pal
+from scipy.spatial import distance as ssd
+from threadpoolctl import threadpool_limits
+
+sys.path.insert(0, str(pal.Path(__file__).resolve().parents[1] / "figures"))
+from asdfc import stats, conformal
+
+n_subjects = 400
+n_voxels = 20000
+n_test = 20
+n_subtypes = 5
+rng = np.random.default_rng(0)
+
+
+def reference_designs(working_map, regressed_vars, train, test):
+    # The previous implementation: everything is rebuilt from the augmented residual maps
+    residualizer = stats.IncrementalResidualizer(working_map[train], regressed_vars[train])
+    designs = list()
+    partitions = list()
+    for test_id in test:
+        resid_map = residualizer.augmented_residuals(working_map[test_id], regressed_vars[test_id])
+        resid_map = ((resid_map - resid_map.mean(1)[:, None]) / resid_map.std(1, ddof=1)[:, None])
+        part = stats.ward_d_cut(ssd.pdist(resid_map), n_subtypes)
+        sub_means = np.array([resid_map[part == sbt_id].mean(0) for sbt_id in range(1, n_subtypes + 1)])
+        designs.append(stats.corr2_coeff(resid_map, sub_means))
+        partitions.append(part)
+    return np.array(partitions), np.array(designs)
+
+
+def incremental_designs(working_map, regressed_vars, train, test):
+    clustering = stats.LeaveOneInClustering(working_map, regressed_vars, train_index=train)
+    subtypes = [clustering.subtypes(working_map[test_id], regressed_vars[test_id], n_subtypes, test_id)
+                for test_id in test]
+    return np.array([part for part, _ in subtypes]), np.array([weights for _, weights in subtypes])
+
+
+# Seed maps with a subtype structure, nuisance design of age and motion and one bootstrap replicate
+centers = rng.normal(size=(n_subtypes, n_voxels))
+working_map = centers[rng.integers(0, n_subtypes, n_subjects)] + 2 * rng.normal(size=(n_subjects, n_voxels))
+regressed_vars = np.column_stack([np.ones(n_subjects), rng.uniform(6, 40, n_subjects), rng.uniform(0, 0.3, n_subjects)])
+bootstrap_train, bootstrap_test = conformal.r_bootstrap_indices(1, n_subjects)
+train = bootstrap_train - 1
+test = bootstrap_test[:n_test] - 1
+
+rows = list()
+results = dict()
+with threadpool_limits(1):
+    for name, func in [("full rebuild", reference_designs), ("incremental", incremental_designs)]:
+        start = time.perf_counter()
+        results[name] = func(working_map, regressed_vars, train, test)
+        rows.append({"implementation": name, "time_s": time.perf_counter() - start})
+
+if not np.array_equal(results["full rebuild"][0], results["incremental"][0]):
+    raise Exception("The incremental partitions differ from the reference")
+if not np.allclose(results["full rebuild"][1], results["incremental"][1], rtol=0, atol=1e-10):
+    raise Exception("The incremental subtype weights differ from the reference")
+print(pd.DataFrame(rows).to_string(index=False, float_format="{:.4f}".format))
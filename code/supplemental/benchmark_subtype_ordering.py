@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Benchmark of the compute-only subtype partition
+# subtype_partition orders the linkage optimally and builds a dendrogram only to return the display order. Batch runs
+# (stability analysis, bootstraps) throw that order away, so they can call it with ordered=False. This script times
+# both on random data of increasing size with five underlying subtypes. The caches are off so that every call builds
+# its tree.
+#
+# On one core (2000 connections):
+#  n_subjects    mode  ordered_s  compute_only_s  speedup
+#         100 classic      0.008           0.006    1.444
+#         100    core      0.004           0.002    2.306
+#         300 classic      0.062           0.031    1.966
+#         300    core      0.030           0.010    3.100
+#        1000 classic      1.925           0.297    6.473
+#        1000    core      0.966           0.096   10.099
+
+import sys
+import time
+import numpy as np
+import pandas as pd
+import pathlib as pal
+
+sys.path.insert(0, str(pal.Path(__file__).resolve().parents[1] / "figures"))
+from asdfc import stats
+
+n_connections = 2000
+n_repeats = 3
+rng = np.random.default_rng(0)
+
+
+def best_time(func):
+    times = list()
+    for i in range(n_repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return np.min(times)
+
+
+rows = list()
+for n_subjects in [100, 300, 1000]:
+    centers = rng.normal(size=(5, n_connections))
+    data = centers[rng.integers(0, 5, n_subjects)] + rng.normal(size=(n_subjects, n_connections))
+    for mode, kwargs in [("classic", {"n_subtypes": 5}), ("core", {"dist_thr": 0.7, "part_thr": 5})]:
+        ordered = best_time(lambda: stats.subtype_partition(data, mode=mode, use_cache=False, **kwargs))
+        compute_only = best_time(
+            lambda: stats.subtype_partition(data, mode=mode, use_cache=False, ordered=False, **kwargs)
+        )
+        rows.append(
+            {
+                "n_subjects": n_subjects,
+                "mode": mode,
+                "ordered_s": ordered,
+                "compute_only_s": compute_only,
+                "speedup": ordered / compute_only,
+            }
+        )
+
+print(pd.DataFrame(rows).to_string(index=False, float_format="{:.3f}".format))
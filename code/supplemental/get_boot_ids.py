@@ -1,7 +1,11 @@
+import sys
 import pandas as pd
 import numpy as np
 from pathlib import Path
 
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "figures"))
+from asdfc import conformal
+
 # Set paths
 root_p = Path("/home/neuromod/ASD_project_clean")
 discovery_p = root_p / "Results/Discovery"
@@ -10,13 +14,8 @@ discovery_p = root_p / "Results/Discovery"
 pheno = pd.read_csv(root_p / "ABIDE1_Pheno_PSM_matched.tsv", sep="\t")
 n_subjects = len(pheno)
 
-boot_ids = np.empty((n_subjects, 100), dtype=int)
-# Extract test subject IDs from each bootstrap replicate
-for replicate in range(1, 101):
-    df = pd.read_csv(discovery_p / f"Results_Instance_{replicate}_Network_1.csv")
-
-    # Store test subject IDs (2nd column)
-    boot_ids[:, replicate - 1] = df.iloc[:, 1].values
+# Test subject IDs (2nd field) of each bootstrap replicate, read from the first network
+boot_ids = np.asarray(conformal.load_discovery_results(discovery_p, networks=[1])[:100, :n_subjects, 1, 0].T, dtype=int)
 
 # Output
 df = pd.DataFrame(boot_ids)
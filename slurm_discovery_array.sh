@@ -0,0 +1,26 @@
+#!/bin/bash
+#SBATCH --account=def-pbellec
+#SBATCH --job-name=ASD_discovery
+#SBATCH --output=ASD_discovery_%A_%a.out
+#SBATCH --error=ASD_discovery_%A_%a.err
+#SBATCH --cpus-per-task=1
+#SBATCH --mem=8G
+#SBATCH --time=03:00:00
+
+# One task of the discovery job array. Write the task list and get the --array specification with
+#   invoke export-discovery-array
+# then submit it with the printed command, e.g.
+#   sbatch --array=0-1799%200 slurm_discovery_array.sh output_data/Discovery/discovery_array.txt
+JOBS_FILE=$1
+shift
+
+# Load required modules
+module load StdEnv/2020
+module load apptainer
+module load python/3.11
+
+echo "🌒 Discovery array task ${SLURM_ARRAY_TASK_ID} via Apptainer..."
+
+# The task id is passed explicitly because apptainer-run clears the environment
+invoke apptainer-run --task run-discovery-array-task \
+    --args "--jobs-file=${JOBS_FILE} --task-id=${SLURM_ARRAY_TASK_ID} --threads=${SLURM_CPUS_PER_TASK} $*"
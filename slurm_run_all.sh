@@ -15,5 +15,7 @@ module load python/3.11
 # Echo a dramatic prelude
 echo "🌑 Beginning full pipeline execution via Apptainer..."
 
-# Run the invoke task inside Apptainer with specified threads
+# Run the invoke task inside Apptainer with specified threads.
+# Discovery results that already exist are skipped, so the discovery jobs can first be spread across nodes with
+# slurm_discovery_array.sh (see invoke export-discovery-array) before this script runs the rest of the pipeline.
 invoke apptainer-run --task run-all --args "--threads=20"
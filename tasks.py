@@ -81,8 +81,18 @@ def fetch_all(c):
     print("✨ All data assets ready.")
 
 ### RUN ANALYSES
+def _import_asdfc():
+    """
+    Import the asdfc package from code/figures. Imported lazily so that setup tasks work without numpy.
+    """
+    asdfc_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "code", "figures")
+    if asdfc_dir not in sys.path:
+        sys.path.insert(0, asdfc_dir)
+    import asdfc
+    return asdfc
+
 @task
-def run_discovery(c, network, replication, debug=False):
+def run_discovery(c, network, replication, debug=False, engine="python"):
     """
     Run the discovery conformal score analysis for selected networks and replications.
 
@@ -90,6 +100,7 @@ def run_discovery(c, network, replication, debug=False):
         network (int): index of network to process using 0-indexing
         replication (int): index of bootstrap replication using 0-indexing
         debug (bool): set TRUE to enable debugging behavior in R script
+        engine (str): "python" for the asdfc conformal engine, "r" for discovery_conformal_score.R
     """
     # Config-driven paths
     output_dir = os.path.relpath(c.config.get("output_discovery", "output_data/Discovery"))
@@ -105,60 +116,151 @@ def run_discovery(c, network, replication, debug=False):
     rep = int(replication) + 1 # cursed 1 indexing
     net = int(network) + 1 # cursed 1 indexing
 
-    result_file = os.path.join(output_dir, f"Results_Instance_{rep}_Network_{net}.csv")
-
-    if os.path.exists(result_file):
-        print(f"🟡 Skipping existing: {result_file}")
+    asdfc = _import_asdfc()
+    if (rep, net) in asdfc.conformal.existing_discovery_results(output_dir):
+        print(f"🟡 Skipping existing: replicate {rep}, network {net} in {output_dir}")
         return
 
     print(f"🔮 Running replicate {rep}, network {net}")
+    if engine == "python":
+        asdfc.conformal.run_discovery_jobs([(rep, net)], working_dir, output_dir, debug=debug)
+        return
+    # The R script reads the network-major store when it is up to date, so rebuild it after a new seed stack
+    asdfc.data.ensure_seed_store(os.path.join(working_dir, "seed_maps_no_cereb.npy"))
     cmd = (
         f"Rscript code/data_analysis/discovery_conformal_score.R "
         f"{rep} {rep} {net} {working_dir} ./{output_dir} {debug_flag}"
     )
     c.run(cmd)
 
+def _discovery_jobs(c, debug):
+    """
+    Pending discovery jobs, longest first according to the timings of past runs.
+    """
+    asdfc = _import_asdfc()
+    output_dir = os.path.relpath(c.config.get("output_discovery", "output_data/Discovery"))
+    replicates = [1] if debug else None
+    jobs = asdfc.scheduler.discovery_job_graph(output_dir, replicates=replicates)
+    timings = asdfc.scheduler.read_job_timings(os.path.join(output_dir, asdfc.scheduler.TIMING_FILE))
+    return asdfc.scheduler.order_jobs_longest_first(jobs, timings)
+
 @task
-def run_discovery_all(c, threads=1, debug=False):
+def run_discovery_all(c, threads=1, debug=False, engine="python", retries=1):
     """
     Run all discovery conformal score analyses (100 replications × 18 networks).
-    Runs in parallel using threads if threads > 1.
+    Jobs with existing results are skipped, the others run longest first on a pool of worker processes.
 
     Args:
-        threads (int): number of threads to use (default: 1, i.e. serial execution)
-        debug (bool): enable debugging behavior in R script
+        threads (int): number of worker processes to use (default: 1, i.e. serial execution)
+        debug (bool): enable debugging behavior (first replication and 20 subjects only)
+        engine (str): "python" runs all jobs in long-lived worker processes that load the seed maps once,
+                      "r" launches one Rscript per job
+        retries (int): number of times a failed job is run again
     """
-    from concurrent.futures import ThreadPoolExecutor, as_completed
+    asdfc = _import_asdfc()
+    output_dir = os.path.relpath(c.config.get("output_discovery", "output_data/Discovery"))
+    working_dir = c.config.get("source_fmri_dir", "source_data/Data")
+    threads = int(threads)
 
-    debug_flag = "--debug" if debug else ""
-    if debug:
-        jobs = [(0, net) for net in range(18)]
-    else:
-        jobs = [(rep, net) for rep in range(100) for net in range(18)]
+    if not os.path.exists(working_dir):
+        print(f"❌ Source fMRI data missing at {working_dir}. Run 'invoke setup-source-data' first.")
+        return
 
-    def run_single(rep_net):
-        rep, net = rep_net
-        c.run(f"invoke run-discovery --replication={rep} --network={net} {debug_flag}")
+    jobs = _discovery_jobs(c, debug)
+    if not jobs:
+        print("🟡 All discovery results already exist. Skipping.")
+        return
 
-    print(f"🧵 Launching discovery with {str(threads)} thread{'s' if threads != 1 else ''}...")
+    print(f"🧵 Launching {len(jobs)} discovery jobs ({engine} engine) with {threads} "
+          f"process{'es' if threads != 1 else ''}...")
+    done = asdfc.scheduler.run_discovery_schedule(jobs, working_dir, output_dir, engine=engine, debug=debug,
+                                                  n_procs=threads, retries=int(retries))
+    print(f"🖤 Full discovery run complete ({len(done)} new results).")
 
-    if threads == 1:
-        for job in jobs:
-            run_single(job)
-    else:
-        with ThreadPoolExecutor(max_workers=threads) as executor:
-            futures = [executor.submit(run_single, job) for job in jobs]
-            for future in as_completed(futures):
-                # fail loudly
-                future.result()
+@task
+def export_discovery_array(c, jobs_file=None, jobs_per_task=1, max_running=None, debug=False):
+    """
+    Write the pending discovery jobs as the task list of a SLURM job array and print the sbatch command to run it.
+
+    Args:
+        jobs_file (str): path to the task list (default: discovery_array.txt in the discovery output folder)
+        jobs_per_task (int): number of jobs run one after the other by each array task
+        max_running (int): maximum number of array tasks running at once (default: no limit)
+        debug (bool): only export the jobs of the debugging run
+    """
+    asdfc = _import_asdfc()
+    output_dir = os.path.relpath(c.config.get("output_discovery", "output_data/Discovery"))
+    jobs_file = jobs_file or os.path.join(output_dir, "discovery_array.txt")
+
+    jobs = _discovery_jobs(c, debug)
+    spec = asdfc.scheduler.write_slurm_array(jobs, jobs_file, jobs_per_task=int(jobs_per_task),
+                                             max_running=int(max_running) if max_running else None)
+    if spec is None:
+        print("🟡 All discovery results already exist. Nothing to export.")
+        return
+
+    # Build the seed store and the results store once here instead of in every array task
+    working_dir = c.config.get("source_fmri_dir", "source_data/Data")
+    asdfc.data.ensure_seed_store(os.path.join(working_dir, "seed_maps_no_cereb.npy"))
+    asdfc.conformal.ensure_discovery_store(output_dir, asdfc.conformal.discovery_n_subjects(working_dir, debug),
+                                           max(asdfc.conformal.N_REPLICATES, max(rep for rep, _ in jobs)))
+
+    debug_flag = " --debug" if debug else ""
+    print(f"📋 Wrote {len(jobs)} jobs to {jobs_file}. Submit them with:")
+    print(f"sbatch --array={spec} slurm_discovery_array.sh {jobs_file}{debug_flag}")
+
+@task
+def run_discovery_array_task(c, jobs_file, task_id=None, threads=1, debug=False, engine="python", retries=1):
+    """
+    Run the discovery jobs of one task of a SLURM job array written by export-discovery-array.
 
-    print("🖤 Full discovery run complete.")
+    Args:
+        jobs_file (str): path to the task list
+        task_id (int): index of the array task (default: $SLURM_ARRAY_TASK_ID)
+        threads (int): number of worker processes to use
+        debug (bool): enable debugging behavior (20 subjects only)
+        engine (str): "python" or "r", see run-discovery-all
+        retries (int): number of times a failed job is run again
+    """
+    asdfc = _import_asdfc()
+    output_dir = os.path.relpath(c.config.get("output_discovery", "output_data/Discovery"))
+    working_dir = c.config.get("source_fmri_dir", "source_data/Data")
+    task_id = os.environ["SLURM_ARRAY_TASK_ID"] if task_id is None else task_id
+
+    jobs = asdfc.scheduler.read_slurm_array_task(jobs_file, task_id)
+    # Another task or a rerun may have finished some of them already
+    done = asdfc.conformal.existing_discovery_results(output_dir)
+    jobs = [job for job in jobs if job not in done]
+
+    print(f"🔮 Array task {task_id}: {len(jobs)} discovery jobs")
+    asdfc.scheduler.run_discovery_schedule(jobs, working_dir, output_dir, engine=engine, debug=debug,
+                                           n_procs=int(threads), retries=int(retries), build_stores=False)
+
+@task
+def consolidate_discovery(c, discovery_dir=None, keep_csv=False):
+    """
+    Move the Results_Instance_*.csv files of a discovery folder into its results store.
+
+    Args:
+        discovery_dir (str): discovery folder (default: output_discovery from invoke.yaml)
+        keep_csv (bool): keep the .csv files after they are copied into the store
+    """
+    asdfc = _import_asdfc()
+    discovery_dir = discovery_dir or c.config.get("output_discovery", "output_data/Discovery")
+    moved = asdfc.conformal.consolidate_discovery_results(discovery_dir, remove=not keep_csv)
+    print(f"🗄️ Consolidated {len(moved)} results into {asdfc.conformal.discovery_store_dir(discovery_dir)}.")
 
 @task
-def run_scores(c, debug=False):
+def run_scores(c, debug=False, engine="python", force=False):
     """
-    Run Discovery_Read_Conformal_Scores.R to aggregate discovery results.
+    Aggregate discovery results into combined p-values per subnet and the split score table.
     Skips if 'table_split.csv' already exists.
+
+    Args:
+        debug (bool): enable debugging behavior (first 20 subjects only)
+        engine (str): "python" for asdfc.aggregate, which also writes table_split.csv,
+                      "r" for Discovery_Read_Conformal_Scores.R
+        force (bool): aggregate again even if 'table_split.csv' exists, e.g. to monitor a partial discovery run
     """
     import os
 
@@ -167,19 +269,32 @@ def run_scores(c, debug=False):
     output_file = os.path.join(discovery_dir, "table_split.csv")
     debug_flag = "TRUE" if debug else "FALSE"
 
-    if os.path.exists(output_file):
+    if os.path.exists(output_file) and not force:
         print(f"✅ Split table already exists at {output_file}. Skipping.")
         return
 
     print(f"🔎 Running conformal score aggregation (debug mode: {debug_flag})...")
+    if engine == "python":
+        asdfc = _import_asdfc()
+        table_split = asdfc.aggregate.write_discovery_tables(discovery_dir, source_dir, debug=debug)
+        n_reps = len(table_split) // table_split["network"].nunique()
+        print(f"🎯 Split score table created from {n_reps} replicates.")
+        return
     cmd = f"Rscript code/data_analysis/Discovery_Read_Conformal_Scores.R {source_dir} {discovery_dir} {debug_flag}"
     c.run(cmd)
     print("🎯 Split score table created.")
 
 @task
-def run_validation(c, output_dir=None, debug=False):
+def run_validation(c, output_dir=None, debug=False, threads=1, engine="python"):
     """
-    Run Validation_Conformal_Score.R to validate discovery results.
+    Validate the discovery results on ABIDE 2 (Validation_Conformal_Score.R).
+
+    Args:
+        output_dir (str): output folder (default: output_validation of the invoke config)
+        debug (bool): enable debugging behavior (20 subjects only)
+        threads (int): number of worker processes, each running one network at a time (python engine only)
+        engine (str): "python" for asdfc.validation, which only runs the networks without results,
+                      "r" for Validation_Conformal_Score.R
     """
     import os
 
@@ -189,27 +304,39 @@ def run_validation(c, output_dir=None, debug=False):
     os.makedirs(output_dir, exist_ok=True)
 
     real_results = glob.glob(os.path.join(output_dir, "Results_Real_Network_*.csv"))
-    if real_results:
-        print(f"🧠 Found {len(real_results)} existing 'real' results. Skipping.")
-        return
-
-    print(f"🔎 Running conformal score validation (debug mode: {debug_flag})...")
-    cmd = f"Rscript code/data_analysis/Validation_Conformal_Score.R {source_dir} {output_dir} {debug_flag}"
-    c.run(cmd)
+    if engine == "python":
+        asdfc = _import_asdfc()
+        if len(real_results) >= asdfc.conformal.N_NETWORKS:
+            print(f"🧠 Found {len(real_results)} existing 'real' results. Skipping.")
+            return
+        print(f"🔎 Running conformal score validation (debug mode: {debug_flag}) with {threads} "
+              f"process{'es' if int(threads) != 1 else ''}...")
+        asdfc.validation.run_validation_jobs(source_dir, output_dir, debug=debug, n_procs=int(threads))
+    else:
+        if real_results:
+            print(f"🧠 Found {len(real_results)} existing 'real' results. Skipping.")
+            return
+        print(f"🔎 Running conformal score validation (debug mode: {debug_flag})...")
+        cmd = f"Rscript code/data_analysis/Validation_Conformal_Score.R {source_dir} {output_dir} {debug_flag}"
+        c.run(cmd)
     print("🎯 Validation of conformal scores complete.")
 
 @task
-def run_validation_read(c, debug=False):
+def run_validation_read(c, debug=False, engine="python"):
     """
-    Run Validation_Read_Conformal_Scores.R to parse validation results.
-    Skips if 'validation_net_split_1_model_1_combined_p_values' already exists.
+    Combine the validation p-values of each network split.
+    Skips if 'validation_net_split_1_model_1_combined_p_values.tsv' already exists.
+
+    Args:
+        debug (bool): enable debugging behavior in R script
+        engine (str): "python" for asdfc.aggregate, "r" for Validation_Read_Conformal_Scores.R
     """
     import os
 
     source_dir = c.config.get("source_fmri_dir", "source_data/Data")
     discovery_dir = c.config.get("output_discovery", "output_data/Discovery")
     validation_dir = c.config.get("output_validation", "output_data/Validation")
-    output_file = os.path.join(validation_dir, "validation_net_split_1_model_1_combined_p_values")
+    output_file = os.path.join(validation_dir, "validation_net_split_1_model_1_combined_p_values.tsv")
     debug_flag = "TRUE" if debug else "FALSE"
 
     if os.path.exists(output_file):
@@ -217,14 +344,25 @@ def run_validation_read(c, debug=False):
         return
 
     print(f"🔎 Running validation score aggregation (debug mode: {debug_flag})...")
-    cmd = f"Rscript code/data_analysis/Validation_Read_Conformal_Scores.R {source_dir} {discovery_dir} {validation_dir} {debug_flag}"
-    c.run(cmd)
+    if engine == "python":
+        asdfc = _import_asdfc()
+        asdfc.aggregate.write_validation_tables(validation_dir)
+    else:
+        cmd = f"Rscript code/data_analysis/Validation_Read_Conformal_Scores.R {source_dir} {discovery_dir} {validation_dir} {debug_flag}"
+        c.run(cmd)
     print("🎯 Split score table created.")
 
 @task
-def run_null(c, output_dir=None, debug=False):
+def run_null(c, output_dir=None, debug=False, threads=1, engine="python"):
     """
-    Run Validation_Conformal_Score.R to validate discovery results.
+    Run the covariate-only null model (Null_Model.R).
+
+    Args:
+        output_dir (str): output folder (default: output_null of the invoke config)
+        debug (bool): enable debugging behavior (first seed and 20 subjects only)
+        threads (int): number of worker processes, each fitting a block of seeds at once (python engine only)
+        engine (str): "python" for asdfc.null_model, which only runs the seeds without results,
+                      "r" for Null_Model.R
     """
     import os
 
@@ -234,13 +372,21 @@ def run_null(c, output_dir=None, debug=False):
     os.makedirs(output_dir, exist_ok=True)
 
     real_results = glob.glob(os.path.join(output_dir, "Results_Instance_*.csv"))
-    if real_results:
-        print(f"🧠 Found {len(real_results)} existing 'real' results. Skipping.")
-        return
-
-    print(f"🔎 Running null permutation experiments (debug mode: {debug_flag})...")
-    cmd = f"Rscript code/data_analysis/Null_Model.R {source_dir} {output_dir} {debug_flag}"
-    c.run(cmd)
+    if engine == "python":
+        asdfc = _import_asdfc()
+        print(f"🔎 Running null permutation experiments (debug mode: {debug_flag}) with {threads} "
+              f"process{'es' if int(threads) != 1 else ''}...")
+        done = asdfc.null_model.run_null_jobs(source_dir, output_dir, debug=debug, n_procs=int(threads))
+        if not done:
+            print(f"🧠 Found {len(real_results)} existing 'real' results. Skipping.")
+            return
+    else:
+        if real_results:
+            print(f"🧠 Found {len(real_results)} existing 'real' results. Skipping.")
+            return
+        print(f"🔎 Running null permutation experiments (debug mode: {debug_flag})...")
+        cmd = f"Rscript code/data_analysis/Null_Model.R {source_dir} {output_dir} {debug_flag}"
+        c.run(cmd)
     print("🎯 Null experiments complete.")
 
 @task
@@ -264,9 +410,9 @@ def run_all(c, smoke_test=False, threads=1):
         flag_smoke_test=""
     c.run(f"invoke run-discovery-all --threads={threads}{flag_smoke_test}")
     c.run(f"invoke run-scores{flag_smoke_test}")
-    c.run(f"invoke run-validation{flag_smoke_test}")
+    c.run(f"invoke run-validation --threads={threads}{flag_smoke_test}")
     c.run(f"invoke run-validation-read{flag_smoke_test}")
-    c.run(f"invoke run-null{flag_smoke_test}")
+    c.run(f"invoke run-null --threads={threads}{flag_smoke_test}")
     if smoke_test:
         print("🖤 Smoke test complete.")
     else: